@@ -9,6 +9,9 @@ class App:
         pyxel.init(160, 120, title="8bit bgm player")
         with open(f"./{MUSIC_FILE}.json", "rt") as fin:
             self.music = json.loads(fin.read())
+        # シード・パラメータ付きの形式ではサウンドは"music"に入っている
+        if isinstance(self.music, dict):
+            self.music = self.music["music"]
         pyxel.run(self.update, self.draw)
 
     def update(self):
@@ -0,0 +1,165 @@
+import argparse
+import json
+import os
+import sys
+import time
+import zipfile
+from multiprocessing import Pool
+from cache import SongCache
+from composer import Composer, load_tables, list_transpose
+from profiler import Profiler
+from sounds import CompileCache, make_midi_bytes
+
+# ワーカープロセスごとに読み込んだ生成用データとキャッシュ
+_tables = None
+_cache = None
+_compile_cache = None
+
+
+def _init_worker(base_dir, cache_dir=None):
+    global _tables, _cache, _compile_cache
+    _tables = load_tables(base_dir)
+    # ベース・ドラムはパラメータが同じなら同じになるので、曲をまたいで再利用できる
+    _compile_cache = CompileCache()
+    # 同じ曲を続けて生成することはないので、メモリには少しだけ持つ
+    _cache = SongCache(_tables, 8, cache_dir) if cache_dir else None
+
+
+# "0-7" / "0,2,5" / "all" 形式の指定を値のリストにする
+def parse_range(value, all_values):
+    if value == "all":
+        return list(all_values)
+    results = []
+    for part in value.split(","):
+        if "-" in part[1:]:
+            sep = part.index("-", 1)
+            start, end = int(part[:sep]), int(part[sep + 1 :])
+            results.extend(range(start, end + 1))
+        else:
+            results.append(int(part))
+    return results
+
+
+# ジョブ（連番、プリセット、トランスポーズ、シード）を順に作る
+def make_jobs(presets, transposes, count, seed):
+    combinations = [(p, t) for p in presets for t in transposes]
+    for index in range(count):
+        preset, transpose = combinations[index % len(combinations)]
+        yield index, preset, transpose, seed + index
+
+
+# 1曲生成してファイルに書き出す（計測する場合は計測結果、キャッシュから出したかも返す）
+# MIDIはファイルにせずバイト列で返し、メインプロセスでまとめてzipにする
+def run_job(job, out_dir, profile=False, wav=False, midi=False):
+    index, preset, transpose, seed = job
+    parm = {"transpose": transpose, "base_highest_note": 26}
+    profiler = Profiler() if profile else None
+    composer = Composer(parm, _tables, profiler, _cache, _compile_cache)
+    composer.set_preset(preset)
+    composer.generate_music(seed=seed)
+    path = os.path.join(out_dir, f"{index:06d}.json")
+    with open(path, "wt") as fout:
+        fout.write(json.dumps(composer.export()))
+    if wav:
+        import synth
+
+        synth.save_wav(composer.music, os.path.join(out_dir, f"{index:06d}.wav"))
+    midi_data = make_midi_bytes(composer.items) if midi else None
+    timings = profiler.to_dict() if profile else None
+    return index, path, timings, composer.from_cache, midi_data
+
+
+def _run_job(args):
+    return run_job(*args)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="batch", description="Generate many songs without the UI."
+    )
+    parser.add_argument("--presets", default="all", help="e.g. 0-7, 0,3,5, all")
+    parser.add_argument("--transpose", default="0", help="e.g. -3-0, 0,5, all")
+    parser.add_argument("--count", type=int, default=100)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--seed", type=int, default=0, help="seed of the first job")
+    parser.add_argument("--out", default="export/batch", help="output directory")
+    parser.add_argument("--data", default=None, help="directory of the json tables")
+    parser.add_argument(
+        "--profile", action="store_true", help="print per-stage timings"
+    )
+    parser.add_argument("--profile-json", default=None, help="save timings as json")
+    parser.add_argument(
+        "--cache-dir", default=None, help="reuse/save generated songs in this folder"
+    )
+    parser.add_argument(
+        "--wav", action="store_true", help="also render WAV files (needs NumPy)"
+    )
+    parser.add_argument(
+        "--midi",
+        action="store_true",
+        help="also save MIDI files into midi.zip",
+    )
+    args = parser.parse_args(argv)
+
+    tables = load_tables(args.data)
+    presets = parse_range(args.presets, range(len(tables["generator"]["preset"])))
+    transposes = parse_range(args.transpose, [elm[0] for elm in list_transpose])
+    os.makedirs(args.out, exist_ok=True)
+    profile = args.profile or args.profile_json is not None
+    jobs = (
+        (job, args.out, profile, args.wav, args.midi)
+        for job in make_jobs(presets, transposes, args.count, args.seed)
+    )
+    profiler = Profiler()
+
+    start = time.perf_counter()
+    done = 0
+    cache_hits = 0
+    midi_path = os.path.join(args.out, "midi.zip")
+    archive = (
+        zipfile.ZipFile(midi_path, "w", zipfile.ZIP_DEFLATED) if args.midi else None
+    )
+    if args.workers <= 1:
+        _init_worker(args.data, args.cache_dir)
+        results = map(_run_job, jobs)
+        pool = None
+    else:
+        pool = Pool(
+            args.workers,
+            initializer=_init_worker,
+            initargs=(args.data, args.cache_dir),
+        )
+        chunksize = max(1, min(64, args.count // (args.workers * 8)))
+        results = pool.imap_unordered(_run_job, jobs, chunksize)
+    try:
+        for index, _, timings, from_cache, midi_data in results:
+            done += 1
+            cache_hits += from_cache
+            if archive:
+                archive.writestr(f"{index:06d}.mid", midi_data)
+            if timings:
+                profiler.merge(timings)
+            if done % 1000 == 0:
+                print(f"{done}/{args.count}", file=sys.stderr)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+        if archive:
+            archive.close()
+    elapsed = time.perf_counter() - start
+    rate = done / elapsed if elapsed else 0
+    print(f"{done} songs in {elapsed:.1f}s ({rate:.1f} songs/sec) -> {args.out}")
+    if args.cache_dir:
+        print(f"cache: {cache_hits}/{done} songs reused from {args.cache_dir}")
+    if args.midi:
+        print(f"midi: {done} songs -> {midi_path}")
+    if args.profile:
+        print(profiler.summary())
+    if args.profile_json:
+        with open(args.profile_json, "wt") as fout:
+            fout.write(profiler.to_json(indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,9 @@
 import pyxel as px
+from collections import OrderedDict
+from fontatlas import FontAtlas, parse_bdf
+
+# 描画用に覚えておく文字列の数（1画面に出る文字列より十分多くする）
+TEXT_CACHE_SIZE = 256
 
 
 # 日本語フォント表示
@@ -14,56 +19,35 @@ class BDFRenderer:
         (1, 1),
     ]
 
+    # ファイル名が.bdfならBDFを全部読み込み、それ以外はフォントアトラスとして
+    # 使う文字だけを初めて描くときに取り出す
     def __init__(self, bdf_filename):
-        self.fontboundingbox = [0, 0, 0, 0]
-        self.fonts = self._parse_bdf(bdf_filename)
+        if bdf_filename.endswith(".bdf"):
+            self.atlas = None
+            self.fontboundingbox, self.fonts = parse_bdf(bdf_filename)
+        else:
+            self.atlas = FontAtlas(bdf_filename)
+            self.fontboundingbox = self.atlas.fontboundingbox
+            self.fonts = {}
         self.screen_ptr = px.screen.data_ptr()
+        # 1行ずつまとめて読み書きできるよう、画面のバッファをバイト列として扱う
+        self.screen = memoryview(self.screen_ptr).cast("B")
         self.screen_width = px.width
+        self.screen_height = px.height
+        self.text_cache = OrderedDict()
 
-    def _parse_bdf(self, bdf_filename):
-        fonts = {}
-        code = None
-        bitmap = None
-        dwidth = 0
-        with open(bdf_filename, "r") as f:
-            for line in f:
-                if line.startswith("ENCODING"):
-                    code = int(line.split()[1])
-                elif line.startswith("DWIDTH"):
-                    dwidth = int(line.split()[1])
-                elif line.startswith("BBX"):
-                    bbx_data = list(map(int, line.split()[1:]))
-                    font_width, font_height, offset_x, offset_y = (
-                        bbx_data[0],
-                        bbx_data[1],
-                        bbx_data[2],
-                        bbx_data[3],
-                    )
-                elif line.startswith("BITMAP"):
-                    bitmap = []
-                elif line.startswith("ENDCHAR"):
-                    fonts[code] = (
-                        dwidth,
-                        font_width,
-                        font_height,
-                        offset_x,
-                        offset_y,
-                        bitmap,
-                    )
-                    bitmap = None
-                elif line.startswith("FONTBOUNDINGBOX"):
-                    # 0:width 1:height 2:offset_x 3:offset_y
-                    self.fontboundingbox = list(map(int, line.split()[1:]))
-                elif bitmap is not None:
-                    hex_string = line.strip()
-                    bin_string = bin(int(hex_string, 16))[2:].zfill(len(hex_string) * 4)
-                    bitmap.append(int(bin_string[::-1], 2))
-        return fonts
+    def _get_font(self, code):
+        if code in self.fonts:
+            return self.fonts[code]
+        if self.atlas is None:
+            return None
+        font = self.atlas.get(code)
+        self.fonts[code] = font
+        return font
 
-    def _draw_font(self, x, y, font, color):
+    # 1文字分のドットを、描画位置からの相対位置(x, y) → 色の辞書に書き込む
+    def _draw_font(self, pixels, x, y, font, color):
         dwidth, font_width, font_height, offset_x, offset_y, bitmap = font
-        screen_ptr = self.screen_ptr
-        screen_width = self.screen_width
         x = x + self.fontboundingbox[2] + offset_x
         y = (
             y
@@ -73,23 +57,81 @@ class BDFRenderer:
             - offset_y
         )
         for j in range(font_height):
-            for i in range(font_width):
-                if (bitmap[j] >> i) & 1:
-                    screen_ptr[(y + j) * screen_width + x + i] = color
+            row = bitmap[j]
+            i = 0
+            while row:
+                if row & 1:
+                    pixels[(x + i, y + j)] = color
+                row >>= 1
+                i += 1
 
-    def text(self, x, y, text, color=7, border_color=None, spacing=0):
+    # 文字列を行ごとのビットマスクにする（相対位置x, y、幅、マスク、色）
+    # マスク・色は1ドット1バイトの整数で、マスクは描かないドットが0xFF、描くドットが0
+    def _rasterize(self, text, color, border_color, spacing):
+        pixels = {}
+        x = 0
         for char in text:
-            code = ord(char)
-            if code not in self.fonts:
+            font = self._get_font(ord(char))
+            if font is None:
                 continue
-            font = self.fonts[code]
             if border_color is not None:
                 for dx, dy in self.BORDER_DIRECTIONS:
-                    self._draw_font(
-                        x + dx,
-                        y + dy,
-                        font,
-                        border_color,
-                    )
-            self._draw_font(x, y, font, color)
+                    self._draw_font(pixels, x + dx, dy, font, border_color)
+            self._draw_font(pixels, x, 0, font, color)
             x += font[0] + spacing
+        rows = {}
+        for (px_x, px_y), c in pixels.items():
+            rows.setdefault(px_y, {})[px_x] = c
+        spans = []
+        for px_y in sorted(rows):
+            row = rows[px_y]
+            left = min(row)
+            width = max(row) - left + 1
+            mask = (1 << (8 * width)) - 1
+            colors = 0
+            for px_x, c in row.items():
+                shift = 8 * (px_x - left)
+                mask ^= 0xFF << shift
+                colors |= c << shift
+            spans.append((left, px_y, width, mask, colors))
+        return tuple(spans)
+
+    # 一度描いた文字列は行ごとのマスクを覚えておき、次からは1行ずつまとめて書き込む
+    # 画面からはみ出す部分は書き込まない
+    def text(self, x, y, text, color=7, border_color=None, spacing=0):
+        key = (text, color, border_color, spacing)
+        spans = self.text_cache.get(key)
+        if spans is None:
+            spans = self._rasterize(text, color, border_color, spacing)
+            self.text_cache[key] = spans
+            while len(self.text_cache) > TEXT_CACHE_SIZE:
+                self.text_cache.popitem(last=False)
+        else:
+            self.text_cache.move_to_end(key)
+        screen = self.screen
+        screen_width = self.screen_width
+        screen_height = self.screen_height
+        for dx, dy, width, mask, colors in spans:
+            sy = y + dy
+            if sy < 0 or sy >= screen_height:
+                continue
+            sx = x + dx
+            if sx < 0 or sx + width > screen_width:
+                # はみ出した分を切り落とす
+                left = max(0, -sx)
+                right = min(width, screen_width - sx)
+                if left >= right:
+                    continue
+                bits = (1 << (8 * (right - left))) - 1
+                mask = (mask >> (8 * left)) & bits
+                colors = (colors >> (8 * left)) & bits
+                sx += left
+                width = right - left
+            pos = sy * screen_width + sx
+            dots = int.from_bytes(screen[pos : pos + width], "little")
+            dots = (dots & mask) | colors
+            screen[pos : pos + width] = dots.to_bytes(width, "little")
+
+    # 表示言語を切り替えたときなど、覚えている文字列を捨てる
+    def clear_cache(self):
+        self.text_cache.clear()
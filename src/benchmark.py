@@ -0,0 +1,220 @@
+import argparse
+import io
+import json
+import os
+import sys
+import time
+import tracemalloc
+import sounds
+from composer import (
+    Composer,
+    load_tables,
+    list_instrumentation,
+    list_tones,
+    list_transpose,
+)
+
+FIXTURES_FILE = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "bench_items.json"
+)
+# 前回の結果からこの割合以上遅くなったら劣化とみなす
+DEFAULT_THRESHOLD = 0.2
+# メモリのピークを計測する回数
+MEMORY_SAMPLES = 8
+# update_musicで変えるパラメータ（メロディを作り直さないもの）
+UPDATE_KEYS = ["speed", "melo_tone", "base_quantize", "drums", "base"]
+
+
+# 生成のパラメータ（プリセット×編成×トランスポーズ）を全部並べる
+def make_cases(tables, transposes):
+    cases = []
+    for preset in range(len(tables["generator"]["preset"])):
+        for instrumentation, _ in list_instrumentation:
+            for transpose in transposes:
+                cases.append((preset, instrumentation, transpose))
+    return cases
+
+
+def make_composer(tables, preset, instrumentation, transpose):
+    composer = Composer({"transpose": transpose, "base_highest_note": 26}, tables)
+    composer.set_preset(preset)
+    composer.parm["instrumentation"] = instrumentation
+    return composer
+
+
+# 固定の行データ（sounds.compile/make_midiの入力）を作って保存
+def make_fixtures(tables):
+    fixtures = []
+    for preset in range(len(tables["generator"]["preset"])):
+        for instrumentation, _ in list_instrumentation:
+            composer = make_composer(tables, preset, instrumentation, 0)
+            items, _ = composer.generate_music(seed=preset)
+            fixtures.append(items)
+    with open(FIXTURES_FILE, "wt") as fout:
+        fout.write(json.dumps(fixtures, separators=(",", ":")))
+    return fixtures
+
+
+def load_fixtures():
+    with open(FIXTURES_FILE, "rt") as fin:
+        return json.loads(fin.read())
+
+
+# 1回ずつの処理時間を計測して集計
+def measure(name, func, args_list):
+    latencies = []
+    start = time.perf_counter()
+    for args in args_list:
+        t = time.perf_counter()
+        func(*args)
+        latencies.append(time.perf_counter() - t)
+    elapsed = time.perf_counter() - start
+    # メモリのピークは別に計測する（tracemallocは処理時間に影響するため）
+    tracemalloc.start()
+    for args in args_list[:MEMORY_SAMPLES]:
+        func(*args)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    latencies.sort()
+    return {
+        "name": name,
+        "count": len(latencies),
+        "per_sec": len(latencies) / elapsed if elapsed else 0,
+        "p50_ms": latencies[len(latencies) // 2] * 1000,
+        "p99_ms": latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000,
+        "peak_kb": peak / 1024,
+    }
+
+
+def bench_generate(tables, cases):
+    def run(preset, instrumentation, transpose, seed):
+        make_composer(tables, preset, instrumentation, transpose).generate_music(
+            seed=seed
+        )
+
+    args_list = [case + (seed,) for seed, case in enumerate(cases)]
+    return measure("generate_music", run, args_list)
+
+
+# update_musicで選べる値（パラメータごと）
+def make_update_values(tables):
+    generator = tables["generator"]
+    return {
+        "speed": [360, 312, 276, 240, 216, 192, 168, 156],
+        "melo_tone": list(range(len(list_tones))),
+        "base_quantize": [12, 13, 14, 15],
+        "drums": list(range(len(generator["drums"]))),
+        "base": list(range(len(generator["base"]))),
+    }
+
+
+def bench_update(tables, cases):
+    update_values = make_update_values(tables)
+
+    # 呼ぶたびに今と違う値（次の候補）に変える（同じ引数で何度呼んでも作り直しになる）
+    def run(composer, key):
+        values = update_values[key]
+        value = composer.parm[key]
+        idx = values.index(value) + 1 if value in values else 0
+        composer.parm[key] = values[idx % len(values)]
+        composer.update_music()
+
+    args_list = []
+    for seed, case in enumerate(cases):
+        composer = make_composer(tables, *case)
+        composer.generate_music(seed=seed)
+        args_list.append((composer, UPDATE_KEYS[seed % len(UPDATE_KEYS)]))
+    return measure("update_music", run, args_list)
+
+
+def bench_compile(tables, fixtures, repeat):
+    args_list = [(items, tables["tones"], tables["patterns"]) for items in fixtures]
+    return measure("sounds.compile", sounds.compile, args_list * repeat)
+
+
+def bench_midi(fixtures, repeat):
+    # 書き出し先は毎回新しくする（同じバッファに書き足すとメモリが増え続ける）
+    def run(items):
+        sounds.make_midi(items, io.BytesIO())
+
+    args_list = [(items,) for items in fixtures]
+    return measure("sounds.make_midi", run, args_list * repeat)
+
+
+def print_results(results):
+    print(
+        f"{'benchmark':<20}{'count':>8}{'per sec':>10}"
+        f"{'p50 ms':>10}{'p99 ms':>10}{'peak KB':>10}"
+    )
+    for r in results:
+        print(
+            f"{r['name']:<20}{r['count']:>8}{r['per_sec']:>10.1f}"
+            f"{r['p50_ms']:>10.3f}{r['p99_ms']:>10.3f}{r['peak_kb']:>10.1f}"
+        )
+
+
+# 保存済みの結果と比べて、劣化したものを返す
+def compare(results, baseline, threshold):
+    base_map = {r["name"]: r for r in baseline["results"]}
+    regressions = []
+    for r in results:
+        base = base_map.get(r["name"])
+        if base is None:
+            continue
+        for key in ("p50_ms", "p99_ms"):
+            if r[key] > base[key] * (1 + threshold):
+                regressions.append(
+                    f"{r['name']} {key}: {base[key]:.3f} -> {r[key]:.3f}"
+                )
+        if r["per_sec"] < base["per_sec"] / (1 + threshold):
+            regressions.append(
+                f"{r['name']} per_sec: {base['per_sec']:.1f} -> {r['per_sec']:.1f}"
+            )
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="benchmark", description="Benchmark generation, compile and MIDI export."
+    )
+    parser.add_argument("--quick", action="store_true", help="transpose 0 only")
+    parser.add_argument("--repeat", type=int, default=5, help="compile/midi rounds")
+    parser.add_argument("--save", default=None, help="save results as a baseline")
+    parser.add_argument("--compare", default=None, help="baseline json to compare")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD)
+    parser.add_argument(
+        "--make-fixtures", action="store_true", help="regenerate bench_items.json"
+    )
+    args = parser.parse_args(argv)
+
+    tables = load_tables()
+    if args.make_fixtures or not os.path.exists(FIXTURES_FILE):
+        fixtures = make_fixtures(tables)
+    else:
+        fixtures = load_fixtures()
+    transposes = [0] if args.quick else [elm[0] for elm in list_transpose]
+
+    cases = make_cases(tables, transposes)
+    results = [
+        bench_generate(tables, cases),
+        bench_update(tables, cases),
+        bench_compile(tables, fixtures, args.repeat),
+    ]
+    results.append(bench_midi(fixtures, args.repeat))
+    print_results(results)
+
+    if args.save:
+        with open(args.save, "wt") as fout:
+            fout.write(json.dumps({"results": results}, indent=2))
+    if args.compare:
+        with open(args.compare, "rt") as fin:
+            baseline = json.loads(fin.read())
+        regressions = compare(results, baseline, args.threshold)
+        for regression in regressions:
+            print("REGRESSION", regression)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
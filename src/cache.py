@@ -0,0 +1,93 @@
+import gzip
+import hashlib
+import json
+import os
+from collections import OrderedDict
+from composer import IGNORED_PARM
+from grid import SongGrid
+
+DEFAULT_MAXSIZE = 64
+
+
+# 生成用データ（tables）のハッシュ（データを書き換えたら別のキーになる）
+def tables_hash(tables):
+    data = json.dumps(tables, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha1(data.encode("utf-8")).hexdigest()
+
+
+# 生成した曲のキャッシュ（パラメータ・シード・生成用データ → 行データとサウンド）
+# メモリ上はLRUでmaxsize件まで、cache_dirを指定するとgzipしたjsonをファイルにも保存する
+# メモリ上の行データはSongGridで持ち、取り出すたびに新しいリストに戻す（書き換えても影響しない）
+class SongCache:
+    def __init__(self, tables, maxsize=DEFAULT_MAXSIZE, cache_dir=None):
+        self.data_hash = tables_hash(tables)
+        self.maxsize = maxsize
+        self.cache_dir = cache_dir
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    # パラメータのうち生成結果に影響するもの（シードとは別に、同じ曲を探すのに使う）
+    def parm_key(self, parm):
+        values = {k: v for k, v in parm.items() if not k in IGNORED_PARM}
+        return json.dumps(values, sort_keys=True)
+
+    def make_key(self, parm, seed):
+        key = f"{self.parm_key(parm)}|{seed}|{self.data_hash}"
+        return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+    def get_path(self, key):
+        return os.path.join(self.cache_dir, key + ".json.gz")
+
+    # (items, music)を返す（なければNone）
+    def get(self, parm, seed):
+        key = self.make_key(parm, seed)
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            grid, music = self.entries[key]
+            return grid.to_items(), music
+        if self.cache_dir and os.path.exists(self.get_path(key)):
+            with gzip.open(self.get_path(key), "rt", encoding="utf-8") as fin:
+                data = json.loads(fin.read())
+            self.store(key, (SongGrid.from_items(data["items"]), data["music"]))
+            self.disk_hits += 1
+            return data["items"], data["music"]
+        self.misses += 1
+        return None
+
+    def put(self, parm, seed, items, music):
+        key = self.make_key(parm, seed)
+        self.store(key, (SongGrid.from_items(items), music))
+        if self.cache_dir:
+            data = json.dumps({"items": items, "music": music}, separators=(",", ":"))
+            # 並列に書き込んでも壊れたファイルが読まれないよう、書き終えてから置き換える
+            path = self.get_path(key)
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            with gzip.open(tmp_path, "wt", encoding="utf-8") as fout:
+                fout.write(data)
+            os.replace(tmp_path, path)
+
+    # メモリに追加（maxsizeを超えたら古いものから捨てる）
+    def store(self, key, entry):
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
+
+    def stats(self):
+        total = self.hits + self.disk_hits + self.misses
+        return {
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": (self.hits + self.disk_hits) / total if total else 0,
+            "size": len(self.entries),
+            "maxsize": self.maxsize,
+        }
@@ -0,0 +1,974 @@
+import json
+import os
+import random
+import sounds
+from profiler import NULL_PROFILER
+from tables import Tables, get_index, find_lower_tone
+
+SUBMELODY_DIFF = 0
+SUB_RHYTHM = [0, None, 0, None, 0, None, 0, None, 0, None, 0, None, 0, None, 0, None]
+
+# 生成する曲の小節数（8固定、エンドレス再生ではこの単位で続きを生成する）
+BARS_NUMBERS = 8
+
+# コード区間ごとのやり直し回数の上限
+SEGMENT_RETRY_LIMIT = 8
+# メロディ全体の作り直し回数の上限
+MELODY_RETRY_LIMIT = 16
+
+
+# 区切りながら処理するジェネレータ（iter_items等）を最後まで進めて、戻り値を返す
+def run_steps(steps):
+    while True:
+        try:
+            next(steps)
+        except StopIteration as e:
+            return e.value
+
+
+# パラメータを変えたときに作り直すもの（ここにないパラメータはメロディから作り直す）
+#   compile: 全チャンネルのサウンドだけ / tone: 最初の行とそのチャンネルのサウンド
+#   drums: ドラムの列とそのチャンネル / base: ベースと、ベースに合わせるサブメロディ
+PARM_DEPENDENCIES = {
+    "speed": "compile",
+    "melo_tone": "tone",
+    "sub_tone": "tone",
+    "base_quantize": "tone",
+    "drums": "drums",
+    "base": "base",
+}
+# 生成結果に影響しないパラメータ
+IGNORED_PARM = ("preset", "language", "endless")
+
+# パラメータ指定用
+list_instrumentation = [
+    (0, "Melo(with reverb) & Bass"),
+    (1, "Melo & Bass & Drums"),
+    (2, "Melo & Bass & Sub"),
+    (3, "Full (Melo & Bass & Sub & Drums)"),
+]
+list_transpose = [((i + 6) % 12 - 11, i - 5) for i in range(12)]
+list_tones = [
+    (11, "Pulse solid"),
+    (8, "Pulse thin"),
+    (2, "Pulse soft"),
+    (10, "Square solid"),
+    (6, "Square thin (Harp)"),
+    (4, "Square soft (Flute)"),
+]
+list_melo_lowest_note = [
+    (28, "E2"),
+    (29, "F2"),
+    (30, "F#2"),
+    (31, "G2"),
+    (32, "G#2"),
+    (33, "A2"),
+]
+list_melo_use16 = [(True, "Yes"), (False, "No")]
+list_melo_density = [(0, "less"), (2, "normal"), (4, "more")]
+
+
+# 生成用データ（tones/patterns/generator/rhythm）の読み込み
+def load_tables(base_dir=None):
+    if base_dir is None:
+        base_dir = os.path.dirname(os.path.abspath(__file__))
+    tables = Tables()
+    for key, filename in (
+        ("tones", "tones.json"),
+        ("patterns", "patterns.json"),
+        ("generator", "generator.json"),
+        ("rhythm", "rhythm.json"),
+    ):
+        with open(os.path.join(base_dir, filename), "rt", encoding="utf-8") as fin:
+            tables[key] = json.loads(fin.read())
+    return tables
+
+
+# メロディのリズム（音の開始位置と種類を並べたもの。最後に曲の終わりの番兵が2つ入る）
+# 位置 → 何番目の音か、何番目の音から4ステップ以内の間隔でどこまで続くかを持っておく
+class RhythmSet:
+    def __init__(self, rhythms, total_len):
+        self.locs = [r[0] for r in rhythms]
+        self.values = [r[1] for r in rhythms]
+        locs = self.locs
+        # 位置 → その位置以降で最初の音のインデックス（位置は昇順に並んでいる）
+        self.index = []
+        idx = 0
+        for loc in range(total_len + 1):
+            while locs[idx] < loc:
+                idx += 1
+            self.index.append(idx)
+        # インデックス → 次の音との間隔が4以内で続く最後の音のインデックス
+        self.chain_end = list(range(len(locs)))
+        for idx in range(len(locs) - 2, -1, -1):
+            if locs[idx + 1] - locs[idx] <= 4:
+                self.chain_end[idx] = self.chain_end[idx + 1]
+        # インデックス → （位置、次の音までの長さ）
+        self.spans = [(locs[i], locs[i + 1] - locs[i]) for i in range(len(locs) - 1)]
+
+    def __len__(self):
+        return len(self.locs)
+
+    def __iter__(self):
+        return zip(self.locs, self.values)
+
+    # locの音（locになければその後の音）のインデックス
+    def find(self, loc):
+        return self.index[loc]
+
+    # pat_idx番目の音（位置loc）から、コードが変わらず4ステップ以内の間隔で続く音
+    # （位置、長さ）を返す（続く音がなくても1つは返す）
+    def get_following(self, pat_idx, loc, next_chord_loc):
+        locs = self.locs
+        pat_loc = locs[pat_idx + 1]
+        following = [(loc, pat_loc - loc)]
+        if pat_loc >= next_chord_loc or pat_loc - loc > 4:
+            return following
+        last = min(self.chain_end[pat_idx + 1], self.index[next_chord_loc] - 1)
+        return following + self.spans[pat_idx + 1 : last]
+
+
+# 作曲エンジン（Pyxelに依存しないので、ウィンドウなしで実行できる）
+class Composer:
+    def __init__(self, parm, tables, profiler=None, cache=None, compile_cache=None):
+        self.parm = parm
+        self.profiler = profiler or NULL_PROFILER
+        self.cache = cache  # SongCache（指定すると同じパラメータ・シードの曲を再利用する）
+        self.compile_cache = compile_cache  # sounds.CompileCache（チャンネル単位で再利用）
+        self.tones = tables["tones"]
+        self.patterns = tables["patterns"]
+        self.generator = tables["generator"]
+        self.index = get_index(tables)  # tablesから作った検索用の表
+        self.items = []
+        self.music = None
+        self.seed = None
+        self.rng = random.Random()
+        self.from_cache = False  # 直前の曲をキャッシュから取り出したか
+        self.built_parm = None  # 直前の曲を生成したときのパラメータ
+        self.submelody_ops = None  # メインメロディ生成中に置いたサブメロディ（置き直し用）
+        self.submelody_state = None  # サブメロディ生成前の乱数の状態と直前の音
+        self.failure_cnt = 0  # メロディ全体を作り直した回数
+        self.backtrack_cnt = 0  # コード区間をやり直した回数
+
+    @property
+    def total_len(self):
+        return BARS_NUMBERS * 16
+
+    @property
+    def with_submelody(self):
+        return self.parm["instrumentation"] in (2, 3)
+
+    @property
+    def with_drum(self):
+        return self.parm["instrumentation"] in (1, 3)
+
+    # プリセットをパラメータに反映
+    def set_preset(self, value):
+        preset = self.generator["preset"][value]
+        for key in preset:
+            self.parm[key] = preset[key]
+
+    # 乱数（両端を含む整数）
+    def rndi(self, a, b):
+        return self.rng.randint(a, b)
+
+    # シードまたは乱数オブジェクトを指定（どちらもなければ新しいシードを作る）
+    def set_seed(self, seed=None, rng=None):
+        if rng is not None:
+            self.seed = None
+            self.rng = rng
+            return
+        if seed is None:
+            seed = random.randrange(1 << 32)
+        self.seed = seed
+        self.rng = random.Random(seed)
+
+    # 出力用データ（パラメータとシードを記録して再生成できるようにする）
+    def export(self):
+        return {"seed": self.seed, "parm": dict(self.parm), "music": self.music}
+
+    def generate_music(self, make_melody=True, seed=None, rng=None):
+        if make_melody:
+            self.set_seed(seed, rng)
+        # 曲はパラメータとシードで決まるので、キャッシュにあればそれを使う
+        use_cache = self.cache is not None and self.seed is not None
+        self.from_cache = False
+        if use_cache:
+            cached = self.cache.get(self.parm, self.seed)
+            if cached is not None:
+                (self.items, self.music) = cached
+                # 生成中の記録（メロディ・コードなど）がないので、ベースの変更では全体を作り直す
+                self.submelody_ops = None
+                self.from_cache = True
+                self.built_parm = dict(self.parm)
+                self.profiler.count("cache_hits")
+                return self.items, self.music
+        items = self.generate_items(make_melody)
+        # 完了処理
+        with self.profiler.stage("compile"):
+            self.music = sounds.compile(
+                items,
+                self.tones,
+                self.patterns,
+                self.profiler,
+                cache=self.compile_cache,
+            )
+        self.items = items
+        self.built_parm = dict(self.parm)
+        if use_cache:
+            self.cache.put(self.parm, self.seed, self.items, self.music)
+        return self.items, self.music
+
+    # 直前の曲から、変わったパラメータに関係するところだけ作り直す
+    # （メロディに関係するパラメータが変わったときは、同じシードで全体を作り直す）
+    def update_music(self):
+        if self.built_parm is None:
+            return self.generate_music()
+        targets = set()
+        for key in set(self.parm) | set(self.built_parm):
+            if key in IGNORED_PARM or self.parm.get(key) == self.built_parm.get(key):
+                continue
+            if not key in PARM_DEPENDENCIES:
+                return self.generate_music(seed=self.seed)
+            targets.add(PARM_DEPENDENCIES[key])
+        # メロディを作り直した曲は、やり直した回のサブメロディがベースに合わせて乱数を使っているので
+        # ベースが変わるとメロディも変わる（置き直せないときは全体を作り直す）
+        if "base" in targets and self.submelody_ops is None:
+            return self.generate_music(seed=self.seed)
+        if self.cache is not None and self.seed is not None:
+            cached = self.cache.get(self.parm, self.seed)
+            if cached is not None:
+                (self.items, self.music) = cached
+                # 生成中の記録（メロディ・コードなど）がないので、ベースの変更では全体を作り直す
+                self.submelody_ops = None
+                self.built_parm = dict(self.parm)
+                self.from_cache = True
+                self.profiler.count("cache_hits")
+                return self.items, self.music
+        self.from_cache = False
+        # キャッシュや画面が持っている行データは書き換えない
+        items = [item.copy() for item in self.items]
+        channels = set()
+        if "compile" in targets or "tone" in targets:
+            with self.profiler.stage("backing"):
+                self.set_setup_row(items[0])
+        if "compile" in targets:
+            channels.update(range(4))
+        if "tone" in targets:
+            channels.update(self.get_tone_channels())
+        if "drums" in targets and self.with_drum:
+            with self.profiler.stage("backing"):
+                self.set_drums(items)
+            channels.add(3 if self.with_submelody else 2)
+        if "base" in targets:
+            with self.profiler.stage("backing"):
+                self.set_bass(items)
+            channels.add(1)
+            if self.with_submelody:
+                with self.profiler.stage("submelody"):
+                    self.replay_submelody()
+                for loc in range(self.total_len):
+                    items[loc][14] = self.submelody_notes[loc]
+                channels.add(2)
+        music = list(self.music)
+        if channels:
+            with self.profiler.stage("compile"):
+                sounds_part = sounds.compile(
+                    items,
+                    self.tones,
+                    self.patterns,
+                    self.profiler,
+                    channels,
+                    self.compile_cache,
+                )
+            for ch in channels:
+                music[ch] = sounds_part[ch]
+        self.profiler.count("compiled_channels", len(channels))
+        self.items = items
+        self.music = music
+        self.built_parm = dict(self.parm)
+        if self.cache is not None and self.seed is not None:
+            self.cache.put(self.parm, self.seed, self.items, self.music)
+        return self.items, self.music
+
+    # 最初の行の音色・音長が変わったとき、作り直すチャンネル
+    def get_tone_channels(self):
+        changed = [
+            key
+            for key in ("melo_tone", "base_quantize", "sub_tone")
+            if self.parm.get(key) != self.built_parm.get(key)
+        ]
+        channels = set()
+        if "melo_tone" in changed:
+            channels.add(0)
+            if not self.with_submelody and not self.with_drum:  # リバーブ
+                channels.add(2)
+        if "base_quantize" in changed:
+            channels.add(1)
+        if "sub_tone" in changed and self.with_submelody:
+            channels.add(2)
+        return channels
+
+    # 行データを生成（prev_itemsに直前の区間を渡すと、その続きとして生成する）
+    def generate_items(self, make_melody=True, prev_items=None):
+        return run_steps(self.iter_items(make_melody, prev_items))
+
+    # generate_itemsを、バッキング・コード区間・サブメロディごとに区切って進めるジェネレータ
+    # （最後まで進めると行データを返す。区切り方で乱数の使い方は変わらない）
+    def iter_items(self, make_melody=True, prev_items=None):
+        # 直前の区間の最後のメロディ・サブの音
+        prev_note = -1
+        prev_subnote = -1
+        if prev_items:
+            prev_note = self.get_last_note(prev_items, 6)
+            if self.with_submelody:
+                prev_subnote = self.get_last_note(prev_items, 14)
+        # コードリスト準備
+        self.set_chord_lists()
+        # バッキング生成
+        with self.profiler.stage("backing"):
+            items = self.generate_backing()
+        yield
+        # メロディー生成（コード区間単位でやり直しても必須音が揃わなければ全体を作り直す）
+        if make_melody:
+            self.failure_cnt = 0
+            self.backtrack_cnt = 0
+            while True:
+                with self.profiler.stage("melody"):
+                    complete = yield from self.iter_melody(prev_note)
+                # サブメロディも作り直すたびに生成する（乱数の進み方、つまりシードごとの曲を変えない）
+                with self.profiler.stage("submelody"):
+                    self.submelody_state = (self.rng.getstate(), prev_subnote)
+                    self.generate_submelody(prev_subnote)
+                yield
+                if complete:
+                    break
+                self.failure_cnt += 1
+                # 上限に達したら最後に生成したメロディを採用する
+                if self.failure_cnt >= MELODY_RETRY_LIMIT:
+                    break
+            # どの位置にも音（休符・継続を含む）が置かれている
+            assert not -2 in self.melody_notes, "melody has unplaced steps"
+            # やり直した回のサブメロディの分は置き直せない
+            if self.failure_cnt:
+                self.submelody_ops = None
+            self.profiler.count("melody_retries", self.failure_cnt)
+            self.profiler.count("segment_backtracks", self.backtrack_cnt)
+        # メロディ・サブとリバーブの音符を設定
+        for loc in range(self.total_len):
+            item = items[loc]
+            item[6] = self.melody_notes[loc]
+            if self.with_submelody:
+                item[14] = self.submelody_notes[loc]
+            elif not self.with_drum:  # リバーブ
+                if loc == 0 and prev_items:
+                    item[14] = prev_items[-1][6]
+                else:
+                    item[14] = self.melody_notes[
+                        (loc + self.total_len - 1) % self.total_len
+                    ]
+        return items
+
+    # 行データのidx列で最後に置かれた音
+    def get_last_note(self, items, idx):
+        for item in reversed(items):
+            if not item[idx] is None:
+                return item[idx]
+        return -1
+
+    # ベースとドラムを配置した行データを生成
+    def generate_backing(self):
+        items = [[None for _ in range(19)] for _ in range(self.total_len)]
+        self.set_setup_row(items[0])
+        self.set_bass(items)
+        if self.with_drum:
+            self.set_drums(items)
+        return items
+
+    # 最初の行（セットアップ）
+    def set_setup_row(self, item):
+        parm = self.parm
+        item[0] = parm["speed"]  # テンポ
+        item[1] = 48  # 4/4拍子
+        item[2] = 3  # 16分音符
+        item[3] = list_tones[parm["melo_tone"]][0]  # メロディ音色
+        item[4] = 6  # メロディ音量
+        item[5] = 14  # メロディ音長
+        item[7] = 7  # ベース音色
+        item[8] = 7  # ベース音量
+        item[9] = parm["base_quantize"]  # ベース音長
+        if self.with_submelody:
+            item[11] = list_tones[parm["sub_tone"]][0]
+            item[12] = 4
+            item[13] = 15
+            if self.with_drum:
+                item[15] = 15
+                item[16] = 5
+                item[17] = 15
+        elif self.with_drum:
+            item[11] = 15
+            item[12] = 5
+            item[13] = 15
+        else:  # リバーブ
+            item[11] = item[3]
+            item[12] = 2
+            item[13] = item[5]
+
+    # ベース音設定（self.base_notesも更新する）
+    def set_bass(self, items):
+        parm = self.parm
+        base = self.generator["base"][parm["base"]]
+        self.base_notes = []
+        self.cur_chord_idx = -1
+        for loc in range(self.total_len):
+            (chord_idx, _) = self.get_chord(loc)
+            if chord_idx > self.cur_chord_idx:
+                chord_list = self.chord_lists[chord_idx]
+                self.cur_chord_idx = chord_idx
+                self.cur_chord_loc = loc
+            item = items[loc]
+            tick = loc % 16  # 拍(0-15)
+            if not chord_list["repeat"] is None:
+                repeat_loc = self.chord_lists[chord_list["repeat"]]["loc"]
+                target_loc = repeat_loc + loc - self.cur_chord_loc
+                item[10] = items[target_loc][10]
+            else:
+                pattern = "basic" if loc // 16 < 7 else "final"
+                base_str = base[pattern][tick]
+                if base_str == ".":
+                    base_note = None
+                elif base_str == "0":
+                    base_note = -1
+                else:
+                    highest = parm["base_highest_note"]
+                    pattern = "basic" if loc // 16 < 7 else "final"
+                    base_root = 12 + parm["transpose"] + chord_list["base"]
+                    while base_root + 24 > highest:
+                        base_root -= 12
+                    notes = chord_list["notes_origin"]
+                    adjust_list = [0, -1, 1, -2, 2, -3, 3]
+                    adjust_idx = 0
+                    base_add = {"1": 7, "2": 12, "3": 19, "4": 24}[base_str]
+                    while notes:
+                        adjust = adjust_list[adjust_idx]
+                        base_note = base_root + base_add + adjust
+                        tmp = (base_note + parm["transpose"]) % 12
+                        # print(notes, tmp, notes[tmp])
+                        if notes[(base_note + parm["transpose"]) % 12] in [1, 2, 3]:
+                            break
+                        adjust_idx += 1
+                item[10] = base_note
+            self.base_notes.append(base_note)
+
+    # ドラム音設定
+    def set_drums(self, items):
+        drums = self.generator["drums"][self.parm["drums"]]
+        idx = 18 if self.with_submelody else 14
+        for loc in range(self.total_len):
+            tick = loc % 16  # 拍(0-15)
+            pattern = "basic" if (loc // 16) % 4 < 3 else "final"
+            drum_str = drums[pattern][tick]
+            if drum_str == "0":
+                items[loc][idx] = None
+            else:
+                items[loc][idx] = ":" + drum_str
+
+    # self.chord_listsを生成
+    def set_chord_lists(self):
+        parm = self.parm
+        lowest_note = parm["melo_lowest_note"]
+        if self.with_submelody:
+            lowest_note += SUBMELODY_DIFF
+        self.chord_lists = []
+        for prog_idx, progression in enumerate(self.index.chords[parm["chord"]]):
+            chord_list = {
+                "loc": progression.loc,
+                "base": 0,
+                "no_root": False,
+                "notes": [],
+                "notes_origin": (),
+                "repeat": progression.repeat,
+            }
+            if not progression.repeat is None:
+                chord_list["base"] = self.chord_lists[progression.repeat]["base"]
+            if not progression.notes is None:
+                chord_list["notes_origin"] = progression.notes
+                # ベース音設定
+                if not progression.root is None:
+                    chord_list["base"] = progression.root
+                chord_list["no_root"] = progression.no_root
+                # レンジを決める
+                chord_list["notes"] = list(
+                    self.index.get_chord_notes(
+                        parm["chord"], prog_idx, parm["transpose"], lowest_note
+                    )
+                )
+            # 重要構成音
+            chord_list["need_notes"] = frozenset(
+                chord[0] % 12 for chord in chord_list["notes"] if chord[1] == 1
+            )
+            self.chord_lists.append(chord_list)
+        self.set_chord_timeline()
+
+    # 16分音符ごとの（コードのインデックス、次のコードの開始位置）を作っておく
+    def set_chord_timeline(self):
+        chord_lists = self.chord_lists
+        end_loc = 16 * BARS_NUMBERS
+        self.chord_timeline = []
+        idx = 0
+        for loc in range(end_loc):
+            while idx + 1 < len(chord_lists) and loc >= chord_lists[idx + 1]["loc"]:
+                idx += 1
+            if loc < chord_lists[0]["loc"]:
+                next_chord_loc = chord_lists[0]["loc"]
+            elif idx + 1 < len(chord_lists):
+                next_chord_loc = chord_lists[idx + 1]["loc"]
+            else:
+                next_chord_loc = end_loc
+            self.chord_timeline.append((idx, next_chord_loc))
+
+    # メロディ生成（コード区間の必須音が揃わなかったらFalseを返す）
+    def generate_melody(self, prev_note=-1):
+        return run_steps(self.iter_melody(prev_note))
+
+    # generate_melodyを、コード区間の切り替わりごとに区切って進めるジェネレータ
+    def iter_melody(self, prev_note=-1):
+        self.melody_notes = [-2 for _ in range(self.total_len)]
+        self.submelody_notes = [-2 for _ in range(self.total_len)]
+        # メインメロディ
+        # print("=== MAIN START ===")
+        rhythm_main_list = []
+        with self.profiler.stage("rhythm"):
+            for _ in range(5):
+                rhythm_main_list.append(self.get_rhythm_set())
+            rhythm_main_list.sort(key=len)
+        rhythm_main = rhythm_main_list[self.parm["melo_density"]]
+        yield
+        self.prev_note = prev_note
+        self.submelody_ops = []
+        complete = True
+        segment = None
+        loc = 0
+        while True:
+            # コード区間の切り替わり（曲の終わりを含む）
+            chord_idx = self.get_chord(loc)[0] if loc < self.total_len else None
+            if segment is None or chord_idx != segment["chord_idx"]:
+                yield
+                # 直前の区間に足りない必須音があれば、その区間だけやり直す
+                if segment is not None and self.get_missing_notes(
+                    segment["chord_idx"], segment["loc"], loc
+                ):
+                    # やり直しの上限に達したら、曲全体を作り直す
+                    if segment["retry"] >= SEGMENT_RETRY_LIMIT:
+                        complete = False
+                    else:
+                        segment["retry"] += 1
+                        self.backtrack_cnt += 1
+                        # 半分やり直してもだめならリズムも選び直す
+                        if segment["retry"] > SEGMENT_RETRY_LIMIT // 2:
+                            rhythm_main = self.redraw_rhythm(
+                                rhythm_main,
+                                segment["loc"],
+                                loc,
+                                len(self.get_need_notes(segment["chord_idx"])),
+                            )
+                        loc = self.restore_segment(segment)
+                        continue
+                if chord_idx is None:
+                    break
+                segment = self.save_segment(loc, chord_idx)
+            # すでに埋まっていたらスキップ
+            if self.melody_notes[loc] != -2:
+                loc += 1
+                continue
+            # 1セットの音を追加
+            notesets = self.get_next_notes(rhythm_main, loc)
+            if notesets is None:  # repeat
+                repeat_loc = self.chord_lists[self.chord_list["repeat"]]["loc"]
+                target_loc = repeat_loc + loc - self.cur_chord_loc
+                repeat_note = self.melody_notes[target_loc]
+                self.put_melody(loc, repeat_note, 1)
+                repeat_subnote = self.submelody_notes[target_loc]
+                self.submelody_notes[loc] = repeat_subnote
+                self.submelody_ops.append((loc, 0, None, target_loc))
+            else:
+                notesets_len = 0
+                for noteset in notesets:
+                    self.put_melody(noteset[0], noteset[1], noteset[2])
+                    notesets_len += noteset[2]
+                self.put_submelody(loc, -2, notesets_len)
+                self.submelody_ops.append((loc, notesets_len, self.chord_list, None))
+                # 先取音で繰り返しの区間に入ったときは何も置かれないので、休符にする
+                if not notesets:
+                    self.melody_notes[loc] = -1
+            loc += 1
+        # 後から置いた音で前の区間が変わっていないか、最後に全区間を確かめ直す
+        if complete and self.get_missing_segment() is not None:
+            complete = False
+        return complete
+
+    # サブメロディ（メインメロディの後で空いているところを埋める）
+    def generate_submelody(self, prev_note=-1):
+        # print("=== SUB START ===")
+        rhythm_sub = self.get_rhythm_set(True)
+        self.prev_note = prev_note
+        prev_note_loc = -1
+        for loc in range(self.total_len):
+            note = self.submelody_notes[loc]
+            if not note is None and note >= 0:
+                prev_note_loc = loc
+                self.prev_note = note
+            elif loc - prev_note_loc >= 4 and loc % 4 == 0:
+                notesets = self.get_next_notes(rhythm_sub, loc, True)
+                if not notesets is None:
+                    for noteset in notesets:
+                        self.put_submelody(noteset[0], noteset[1], noteset[2])
+                    prev_note_loc = loc
+
+    # メインメロディ生成中に置いたサブメロディを、今のベースで置き直してから
+    # サブメロディの2回目（空いているところを埋める）をやり直す
+    def replay_submelody(self):
+        melody_notes = self.melody_notes
+        # 置いたときのメロディ（まだ置いていないところは-2）を再現する
+        self.melody_notes = [-2 for _ in range(self.total_len)]
+        self.submelody_notes = [-2 for _ in range(self.total_len)]
+        filled = 0
+        for loc, note_len, chord_list, target_loc in self.submelody_ops:
+            if target_loc is None:
+                while filled < loc + note_len:
+                    self.melody_notes[filled] = melody_notes[filled]
+                    filled += 1
+                self.chord_list = chord_list
+                self.put_submelody(loc, -2, note_len)
+            else:
+                self.submelody_notes[loc] = self.submelody_notes[target_loc]
+        self.melody_notes = melody_notes
+        (rng_state, prev_subnote) = self.submelody_state
+        self.rng.setstate(rng_state)
+        self.generate_submelody(prev_subnote)
+
+    # コード区間の開始時点の状態を保存
+    def save_segment(self, loc, chord_idx):
+        return {
+            "loc": loc,
+            "chord_idx": chord_idx,
+            "retry": 0,
+            "melody_notes": self.melody_notes.copy(),
+            "submelody_notes": self.submelody_notes.copy(),
+            "submelody_ops": len(self.submelody_ops),
+            "state": (
+                self.cur_chord_idx,
+                self.cur_chord_loc,
+                self.is_repeat,
+                self.chord_list,
+                self.prev_note,
+                self.first_in_chord,
+                self.need_notes.copy(),
+            ),
+        }
+
+    # コード区間の開始時点に戻す（戻した位置を返す）
+    def restore_segment(self, segment):
+        self.melody_notes = segment["melody_notes"].copy()
+        self.submelody_notes = segment["submelody_notes"].copy()
+        (
+            self.cur_chord_idx,
+            self.cur_chord_loc,
+            self.is_repeat,
+            self.chord_list,
+            self.prev_note,
+            self.first_in_chord,
+            need_notes,
+        ) = segment["state"]
+        self.need_notes = need_notes.copy()
+        del self.submelody_ops[segment["submelody_ops"] :]
+        return segment["loc"]
+
+    # メロディのリズムを取得
+    def get_rhythm_set(self, is_sub=False):
+        self.cur_chord_idx = -1  # 現在のコード（self.chord_listsのインデックス）
+        self.cur_chord_loc = -1  # 現在のコードの開始位置
+        self.is_repeat = False  # リピートモード
+        self.chord_list = []
+        self.prev_note = -1  # 直前のメロディー音
+        self.first_in_chord = True  # コード切り替え後の最初のノート
+        self.need_notes = set()  # 現在のコードでまだ入っていない重要構成音
+        while True:
+            # 16分音符が出なかったら全小節を選び直す
+            results = []
+            used16 = False
+            for bar in range(BARS_NUMBERS):
+                if is_sub:
+                    pat_line = SUB_RHYTHM
+                else:
+                    (pat_line, has16) = self.get_rhythm_line()
+                    if has16:
+                        used16 = True
+                for idx, pat_one in enumerate(pat_line):
+                    loc = bar * 16 + idx
+                    if not pat_one is None:
+                        results.append((loc, pat_one))
+            if is_sub or not self.parm["melo_use16"] or used16:
+                break
+        for _ in range(2):
+            results.append((self.total_len, -1))
+        return RhythmSet(results, self.total_len)
+
+    # メロディのリズムを1小節分選ぶ（16分音符を含むかも返す）
+    def get_rhythm_line(self):
+        rhythm = self.index.rhythm
+        while True:
+            idx = self.rndi(0, len(rhythm) - 1)
+            pat_line = rhythm[idx]
+            has16 = self.index.rhythm_has16[idx]
+            # 16分音符回避設定
+            if has16 and not self.parm["melo_use16"]:
+                continue
+            # 先頭が持続音のものは避ける（暫定）
+            if not pat_line[0] is None:
+                return pat_line, has16
+
+    # コード区間のリズムだけを選び直す（重要構成音の数だけ音符が入るものを優先）
+    def redraw_rhythm(self, rhythm_set, start_loc, end_loc, need_cnt):
+        for _ in range(SEGMENT_RETRY_LIMIT):
+            (pat_line, _) = self.get_rhythm_line()
+            onsets = []
+            for loc in range(start_loc, end_loc):
+                if not pat_line[loc % 16] is None:
+                    onsets.append((loc, pat_line[loc % 16]))
+            if len([o for o in onsets if o[1] == 0]) >= need_cnt:
+                break
+        if not onsets or onsets[0][0] != start_loc:
+            onsets.insert(0, (start_loc, 0))
+        before = [r for r in rhythm_set if r[0] < start_loc]
+        after = [r for r in rhythm_set if r[0] >= end_loc]
+        return RhythmSet(before + onsets + after, self.total_len)
+
+    def get_next_notes(self, rhythm_set, loc, is_sub=False):
+        pat_idx = rhythm_set.find(loc)
+        pat = rhythm_set.values[pat_idx] if rhythm_set.locs[pat_idx] == loc else None
+        note_len = rhythm_set.locs[pat_idx + 1] - loc
+        # コード切替判定
+        change_code = False
+        premonitory = False
+        (next_chord_idx, next_chord_loc) = self.get_chord(loc)
+        if next_chord_idx > self.cur_chord_idx:
+            change_code = True
+        elif not self.is_repeat and loc + note_len > next_chord_loc:
+            (next_chord_idx, next_chord_loc) = self.get_chord(loc + note_len)
+            change_code = True
+            premonitory = True
+            # print(loc, note_len, "先取音発生")
+        if change_code:
+            self.chord_list = self.chord_lists[next_chord_idx]
+            self.cur_chord_idx = next_chord_idx
+            self.cur_chord_loc = loc
+            self.first_in_chord = True
+            self.is_repeat = not self.chord_list["repeat"] is None
+            self.need_notes = self.get_need_notes(next_chord_idx)
+        # 小節単位の繰り返し
+        if self.is_repeat:
+            # print(loc, "repeat")
+            return [] if premonitory else None
+        if pat == -1:  # 休符
+            # print(loc, "休符")
+            return [(loc, -1, note_len)]
+        # 初期処理
+        self.chord_notes = self.chord_list["notes"]
+        next_idx = self.get_target_note(is_sub, loc)
+        # 連続音を何個置けるか（コード維持＆４分音符以下）
+        following = rhythm_set.get_following(pat_idx, loc, next_chord_loc)
+        loc, note_len = following[0]
+        # 直前のメロディーのインデックスを今のコードリストと照合(構成音から外れていたらNone)
+        cur_idx = None
+        if not premonitory:
+            for idx, note in enumerate(self.chord_notes):
+                if self.prev_note == note[0]:
+                    cur_idx = idx
+                    break
+        # 初音（直前が休符 or コード構成音から外れた場合は、コード構成音を取得）
+        if self.prev_note < 0 or cur_idx is None:
+            # print(loc, "初音")
+            note = self.chord_notes[next_idx][0]
+            return [(loc, note, note_len)]
+        # 各種変数準備
+        results = []
+        diff = abs(next_idx - cur_idx)
+        direction = 1 if next_idx > cur_idx else -1
+        # 刺繍音/同音
+        if diff == 0:
+            cnt = len(following) // 2
+            if cnt and self.rndi(0, 1) and not is_sub:
+                # print(loc, "刺繍音", cnt * 2)
+                for i in range(cnt):
+                    while next_idx == cur_idx:
+                        next_idx = self.get_target_note()
+                    direction = 1 if next_idx > cur_idx else -1
+                    # print(cur_idx, next_idx, self.chord_notes)
+                    note = self.chord_notes[cur_idx + direction][0]
+                    prev_note = self.prev_note
+                    note_follow = following[i * 2]
+                    results.append((note_follow[0], note, note_follow[1]))
+                    note_follow = following[i * 2 + 1]
+                    results.append((note_follow[0], prev_note, note_follow[1]))
+                return results
+            else:
+                # print(loc, "同音")
+                return [(loc, self.prev_note, note_len)]
+        # ステップに必要な長さが足りない/跳躍量が大きい/割合で跳躍音採用
+        if abs(next_idx - cur_idx) > len(following):
+            note = self.chord_notes[next_idx][0]
+            # print(loc, "跳躍")
+            return [(loc, note, note_len)]
+        # ステップ
+        # print(loc, "ステップ", abs(next_idx - cur_idx))
+        i = 0
+        while next_idx != cur_idx:
+            cur_idx += direction
+            note = self.chord_notes[cur_idx][0]
+            note_follow = following[i]
+            results.append((note_follow[0], note, note_follow[1]))
+            i += 1
+        return results
+
+    # コードの重要構成音（12音のインデックス）
+    def get_need_notes(self, chord_idx):
+        return set(self.chord_lists[chord_idx]["need_notes"])
+
+    # コード区間の重要構成音のうち、メロディに入っていないものを返す
+    def get_missing_notes(self, chord_idx, start_loc, end_loc):
+        need_notes = self.get_need_notes(chord_idx)
+        for loc in range(start_loc, end_loc):
+            note = self.melody_notes[loc]
+            if not note is None and note >= 0:
+                need_notes.discard(note % 12)
+        return need_notes
+
+    # 重要構成音が足りない最初のコード区間の開始位置（全区間揃っていればNone）
+    def get_missing_segment(self):
+        start = 0
+        chord_idx = self.get_chord(0)[0]
+        for loc in range(1, self.total_len + 1):
+            next_idx = self.get_chord(loc)[0] if loc < self.total_len else None
+            if next_idx == chord_idx:
+                continue
+            if self.get_missing_notes(chord_idx, start, loc):
+                return start
+            (start, chord_idx) = (loc, next_idx)
+        return None
+
+    # コードリスト取得（locがchords_listsの何番目のコードか、次のコードの開始位置を返す）
+    def get_chord(self, loc):
+        if loc < 0:
+            return 0, self.chord_lists[0]["loc"]
+        if loc >= len(self.chord_timeline):  # 曲の終わりより後は最後のコード
+            return len(self.chord_lists) - 1, 16 * BARS_NUMBERS
+        return self.chord_timeline[loc]
+
+    # 跳躍音の跳躍先を決定
+    def get_target_note(self, is_sub=False, loc=None):
+        no_root = self.first_in_chord or self.chord_list["no_root"]
+        allowed_types = [1, 3] if no_root else [1, 2, 3]
+        notes = self.get_subnotes(loc) if is_sub else self.chord_list["notes"]
+        # 跳躍先候補が1オクターブ超のみの場合、最低音を選択
+        hightest_note = 0
+        hightest_idx = 0
+        for idx, noteset in enumerate(notes):
+            if noteset[0] > hightest_note and noteset[1] in allowed_types:
+                hightest_note = noteset[0]
+                hightest_idx = idx
+        if self.prev_note - hightest_note > 12:
+            return hightest_idx
+        while True:
+            idx = self.rndi(0, len(notes) - 1)
+            if not notes[idx][1] in allowed_types:
+                continue
+            note = notes[idx][0]
+            if self.prev_note >= 0:
+                diff = abs(self.prev_note - note)
+                if diff > 12:
+                    continue
+                factor = diff if diff != 12 else diff - 6
+                # 近い音ほど出やすい（オクターブ差は補正、サブはそうではない）
+                if self.rndi(0, 15) < factor and not is_sub:
+                    continue
+            # まだ入っていない重要構成音を優先する
+            if not is_sub and self.need_notes and not note % 12 in self.need_notes:
+                if self.rndi(0, 1):
+                    continue
+            return idx
+
+    # メロディのトーンを配置
+    def put_melody(self, loc, note, note_len=1):
+        for idx in range(note_len):
+            self.melody_notes[loc + idx] = note if idx == 0 else None
+        self.profiler.count("notes_placed")
+        if note is not None:
+            self.prev_note = note
+            self.first_in_chord = False
+            if note >= 0:
+                self.need_notes.discard(note % 12)
+
+    # サブメロディのトーンを配置
+    def put_submelody(self, loc, note, note_len=1):
+        master_note = None
+        subnote = note
+        master_loc = loc
+        while master_loc >= 0:
+            master_note = self.melody_notes[master_loc]
+            if not master_note is None and master_note >= 0:
+                prev_note = master_note if note == -2 else note
+                subnote = self.search_downer_note(prev_note, master_note, master_loc)
+                break
+            master_loc -= 1
+        prev_subnote = None
+        for idx in range(note_len):
+            if (
+                not self.melody_notes[loc + idx] is None
+                and self.melody_notes[loc + idx] >= 0
+            ):
+                master_note = self.melody_notes[loc + idx]
+            duplicate = (
+                not master_note is None
+                and not subnote is None
+                and (abs(subnote > master_note) < 3)
+            )
+            if duplicate:
+                subnote = self.search_downer_note(subnote, master_note, loc + idx)
+            self.submelody_notes[loc + idx] = (
+                subnote if subnote != prev_subnote else None
+            )
+            prev_subnote = subnote
+
+    # メロの下ハモを探す
+    def search_downer_note(self, prev_note, master_note, loc):
+        if self.with_submelody and master_note >= 0:
+            self.get_subnotes(loc)
+            if not prev_note is None and abs(prev_note - master_note) >= 3:
+                return prev_note
+            note = find_lower_tone(
+                self.subnote_tones, master_note - 3, self.parm["melo_lowest_note"]
+            )
+            if not note is None:
+                return note
+        return -1
+
+    # サブパートの許容音域を取得
+    def get_subnotes(self, start_loc):
+        master_note = None
+        base_note = None
+        loc = start_loc
+        while master_note is None or base_note is None:
+            if master_note is None and self.melody_notes[loc] != -1:
+                master_note = self.melody_notes[loc]
+            if base_note is None and self.base_notes[loc] != -1:
+                base_note = self.base_notes[loc]
+            loc = (loc + self.total_len - 1) % self.total_len
+        (results, self.subnote_tones) = self.index.get_subnotes(
+            self.chord_list["notes_origin"],
+            master_note,
+            base_note,
+            self.parm["transpose"],
+        )
+        self.chord_notes = results
+        return results
@@ -0,0 +1,84 @@
+from collections import deque
+import sounds
+from composer import Composer
+
+# 再生位置より何小節先までサウンドを用意しておくか
+BARS_AHEAD = 2
+# 1小節の行数
+BAR_ROWS = 16
+
+
+# エンドレス再生用の曲（BARS_NUMBERS小節ずつ続きを生成して、1小節ずつサウンドにする）
+# stepを1回呼ぶごとに「区間の生成を1段階（コード区間1つ分など）」か「1小節のコンパイル」だけを
+# 行うので、毎フレーム呼んでも処理が詰まらない
+# （プロファイラを渡すと、生成の段階の時間には次のstepまで待っていた時間も含まれる）
+class EndlessSong:
+    def __init__(self, parm, tables, seed=None, profiler=None, bars_ahead=BARS_AHEAD):
+        # 画面の曲（ループ再生用）の状態を変えないよう、専用のComposerを使う
+        composer = Composer(dict(parm), tables, profiler)
+        self.composer = composer
+        self.bars_ahead = bars_ahead
+        self.rows = deque()  # 生成済みでまだコンパイルに渡していない行
+        self.compiled_rows = deque()  # コンパイルに渡したが小節に割り当てていない行
+        self.bars = deque()  # 用意できた小節（行データ、チャンネルごとのサウンド）
+        self.prev_items = None
+        self.section = None  # 生成途中の区間（Composer.iter_items）
+        self.sections = 0
+        composer.set_seed(seed)
+        self.compiler = sounds.iter_compile(
+            self.iter_rows(),
+            composer.tones,
+            composer.patterns,
+            BAR_ROWS,
+            composer.profiler,
+        )
+
+    # 続きの区間の生成を1段階進める（区間ができあがったらTrue）
+    def advance_section(self):
+        composer = self.composer
+        if self.section is None:
+            self.section = composer.iter_items(prev_items=self.prev_items)
+        try:
+            next(self.section)
+            return False
+        except StopIteration as e:
+            items = e.value
+        self.section = None
+        self.rows.extend(items)
+        self.prev_items = items
+        self.sections += 1
+        composer.profiler.count("endless_sections")
+        return True
+
+    # 続きの区間を最後まで生成
+    def add_section(self):
+        while not self.advance_section():
+            pass
+
+    # コンパイル用に行を1つずつ渡す（足りなければその場で続きを生成する）
+    def iter_rows(self):
+        while True:
+            if not self.rows:
+                self.add_section()
+            item = self.rows.popleft()
+            self.compiled_rows.append(item)
+            yield item
+
+    # 1回分の処理を行う（先読みが足りていて何もしなかったらFalse）
+    def step(self):
+        if len(self.bars) >= self.bars_ahead:
+            return False
+        # コンパイルは次のノートまで先読みするので、1区間以上余裕をもって生成しておく
+        if len(self.rows) < self.composer.total_len:
+            self.advance_section()
+            return True
+        sound = next(self.compiler)
+        items = [self.compiled_rows.popleft() for _ in range(BAR_ROWS)]
+        self.bars.append((items, sound))
+        return True
+
+    # 次の小節（行データ、チャンネルごとのサウンド）を取り出す
+    def pop_bar(self):
+        while not self.bars:
+            self.step()
+        return self.bars.popleft()
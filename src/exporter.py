@@ -0,0 +1,73 @@
+import json
+import os
+import threading
+import sounds
+
+# エクスポートの状態
+STATE_RUNNING = "running"
+STATE_DONE = "done"
+STATE_FAILED = "failed"
+
+
+# ファイルの書き出しを別スレッドで行う（画面を止めずに生成・試聴を続けられる）
+# 書き出すデータは作成時のものを使うので、その後に曲を作り直しても影響しない
+# render_wav（パスを受け取ってWAVを書き出す関数）を渡すと、WAVも書き出す
+class ExportJob:
+    def __init__(self, output_path, names, data, items, render_wav=None):
+        self.output_path = output_path
+        self.names = names  # 種類（json/wav/midi）ごとのファイル名
+        self.data = json.loads(json.dumps(data))
+        self.items = [item.copy() for item in items]
+        self.render_wav = render_wav
+        self.steps = ["json", "wav", "midi"] if render_wav else ["json", "midi"]
+        self.done = 0
+        self.state = STATE_RUNNING
+        self.failed_midi = False
+        self.failed_name = None  # 書き出せなかったファイル名
+        self.error = None
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    @property
+    def total(self):
+        return len(self.steps)
+
+    @property
+    def running(self):
+        return self.state == STATE_RUNNING
+
+    @property
+    def failed(self):
+        return self.state == STATE_FAILED
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    # json/wavを書き出せなかったら、そこで止めて失敗にする（MIDIは失敗しても続ける）
+    def run(self):
+        for step in self.steps:
+            path = os.path.join(self.output_path, self.names[step])
+            try:
+                if step == "json":
+                    with open(path, "wt") as fout:
+                        fout.write(json.dumps(self.data))
+                elif step == "wav":
+                    self.render_wav(path)
+                else:
+                    self.save_midi(path)
+            except Exception as e:
+                self.failed_name = self.names[step]
+                self.error = e
+                self.state = STATE_FAILED
+                print(f"{self.failed_name}を出力できませんでした。({e})")
+                return
+            self.done += 1
+        self.state = STATE_DONE
+
+    def save_midi(self, path):
+        try:
+            sounds.make_midi(self.items, path)
+        except:
+            self.failed_midi = True
+            print("MIDIファイルを出力できませんでした。")
+
@@ -0,0 +1,137 @@
+import argparse
+import mmap
+import struct
+import sys
+from bisect import bisect_left
+
+# フォントアトラス（BDFを変換したバイナリ）の形式
+# ヘッダ：マジック、バージョン、FONTBOUNDINGBOX（幅、高さ、x、y）、文字数
+# 続けて文字コードの配列（昇順）と、各文字のデータの位置の配列（どちらもuint32）
+# 文字のデータ：DWIDTH、幅、高さ、xオフセット、yオフセット、ビットマップ（1行ずつ）
+ATLAS_MAGIC = b"BDFA"
+ATLAS_VERSION = 1
+HEADER = struct.Struct("<4sHbbbbI")
+HEADER_SIZE = 16  # 配列の位置を4バイト境界にそろえる
+GLYPH = struct.Struct("<BBBbb")
+
+
+# BDFファイルを読み込む（FONTBOUNDINGBOXと、文字コード → 文字のデータ）
+# ビットマップの各行は、左端のドットが最下位ビットになる整数にする
+def parse_bdf(bdf_filename):
+    fontboundingbox = [0, 0, 0, 0]
+    fonts = {}
+    code = None
+    bitmap = None
+    dwidth = 0
+    with open(bdf_filename, "r") as f:
+        for line in f:
+            if line.startswith("ENCODING"):
+                code = int(line.split()[1])
+            elif line.startswith("DWIDTH"):
+                dwidth = int(line.split()[1])
+            elif line.startswith("BBX"):
+                font_width, font_height, offset_x, offset_y = map(
+                    int, line.split()[1:5]
+                )
+            elif line.startswith("BITMAP"):
+                bitmap = []
+            elif line.startswith("ENDCHAR"):
+                fonts[code] = (
+                    dwidth,
+                    font_width,
+                    font_height,
+                    offset_x,
+                    offset_y,
+                    bitmap,
+                )
+                bitmap = None
+            elif line.startswith("FONTBOUNDINGBOX"):
+                # 0:width 1:height 2:offset_x 3:offset_y
+                fontboundingbox = list(map(int, line.split()[1:]))
+            elif bitmap is not None:
+                hex_string = line.strip()
+                bin_string = bin(int(hex_string, 16))[2:].zfill(len(hex_string) * 4)
+                bitmap.append(int(bin_string[::-1], 2))
+    return fontboundingbox, fonts
+
+
+def row_bytes(font_width):
+    return (font_width + 7) // 8
+
+
+# BDFファイルをフォントアトラスに変換する
+def build_atlas(bdf_filename, atlas_filename):
+    fontboundingbox, fonts = parse_bdf(bdf_filename)
+    codes = sorted(fonts)
+    offsets = []
+    glyphs = bytearray()
+    base = HEADER_SIZE + 8 * len(codes)
+    for code in codes:
+        dwidth, font_width, font_height, offset_x, offset_y, bitmap = fonts[code]
+        offsets.append(base + len(glyphs))
+        glyphs += GLYPH.pack(dwidth, font_width, font_height, offset_x, offset_y)
+        for row in bitmap:
+            glyphs += row.to_bytes(row_bytes(font_width), "little")
+    header = HEADER.pack(ATLAS_MAGIC, ATLAS_VERSION, *fontboundingbox, len(codes))
+    with open(atlas_filename, "wb") as fout:
+        fout.write(header.ljust(HEADER_SIZE, b"\0"))
+        fout.write(struct.pack(f"<{len(codes)}I", *codes))
+        fout.write(struct.pack(f"<{len(offsets)}I", *offsets))
+        fout.write(glyphs)
+    return len(codes)
+
+
+# フォントアトラスの読み込み（使うときに1文字ずつ取り出す）
+class FontAtlas:
+    def __init__(self, atlas_filename):
+        with open(atlas_filename, "rb") as f:
+            try:
+                self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except (OSError, ValueError):  # mmapが使えない環境
+                self.data = f.read()
+        magic, version, *bbox, count = HEADER.unpack_from(self.data)
+        if magic != ATLAS_MAGIC or version != ATLAS_VERSION:
+            raise ValueError(f"{atlas_filename} is not a font atlas")
+        self.fontboundingbox = bbox
+        self.count = count
+        view = memoryview(self.data)
+        codes = view[HEADER_SIZE : HEADER_SIZE + 4 * count]
+        offsets = view[HEADER_SIZE + 4 * count : HEADER_SIZE + 8 * count]
+        if sys.byteorder == "little":
+            self.codes = codes.cast("I")
+            self.offsets = offsets.cast("I")
+        else:
+            self.codes = struct.unpack(f"<{count}I", codes)
+            self.offsets = struct.unpack(f"<{count}I", offsets)
+
+    # 文字のデータ（parse_bdfと同じ形）を返す（なければNone）
+    def get(self, code):
+        idx = bisect_left(self.codes, code)
+        if idx == self.count or self.codes[idx] != code:
+            return None
+        pos = self.offsets[idx]
+        dwidth, font_width, font_height, offset_x, offset_y = GLYPH.unpack_from(
+            self.data, pos
+        )
+        pos += GLYPH.size
+        size = row_bytes(font_width)
+        bitmap = []
+        for _ in range(font_height):
+            bitmap.append(int.from_bytes(self.data[pos : pos + size], "little"))
+            pos += size
+        return (dwidth, font_width, font_height, offset_x, offset_y, bitmap)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="fontatlas", description="Convert a BDF font to a binary font atlas."
+    )
+    parser.add_argument("bdf", help="BDF font file")
+    parser.add_argument("atlas", help="output atlas file")
+    args = parser.parse_args(argv)
+    count = build_atlas(args.bdf, args.atlas)
+    print(f"{count} glyphs -> {args.atlas}")
+
+
+if __name__ == "__main__":
+    main()
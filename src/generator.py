@@ -4,14 +4,35 @@
 # site: https://github.com/shiromofufactory/8bit-bgm-generator
 # license: MIT
 # version: 1.30
+import sys
+
+# バッチ生成はPyxelを読み込まずに動かす（python -m batch として実行する）
+if __name__ == "__main__" and sys.argv[1:2] == ["batch"]:
+    import runpy
+
+    del sys.argv[1]
+    runpy.run_module("batch", run_name="__main__", alter_sys=True)
+    sys.exit()
+
 import pyxel as px
 import json
-import sounds
 import os
 from bdf import BDFRenderer
-
-SUBMELODY_DIFF = 0
-SUB_RHYTHM = [0, None, 0, None, 0, None, 0, None, 0, None, 0, None, 0, None, 0, None]
+from endless import EndlessSong
+from cache import SongCache
+from exporter import ExportJob
+from sounds import CompileCache
+from composer import (
+    Composer,
+    load_tables,
+    BARS_NUMBERS,
+    list_instrumentation,
+    list_transpose,
+    list_tones,
+    list_melo_lowest_note,
+    list_melo_use16,
+    list_melo_density,
+)
 
 LOCAL = False
 try:
@@ -29,34 +50,12 @@ COL_TEXT_BASIC = 1
 COL_TEXT_MUTED = 5
 COL_SHADOW = 0
 
-# 生成する曲の小節数（8固定）
-BARS_NUMBERS = 8
-
-# パラメータ指定用
-list_instrumentation = [
-    (0, "Melo(with reverb) & Bass"),
-    (1, "Melo & Bass & Drums"),
-    (2, "Melo & Bass & Sub"),
-    (3, "Full (Melo & Bass & Sub & Drums)"),
-]
-list_tones = [
-    (11, "Pulse solid"),
-    (8, "Pulse thin"),
-    (2, "Pulse soft"),
-    (10, "Square solid"),
-    (6, "Square thin (Harp)"),
-    (4, "Square soft (Flute)"),
-]
-list_melo_lowest_note = [
-    (28, "E2"),
-    (29, "F2"),
-    (30, "F#2"),
-    (31, "G2"),
-    (32, "G#2"),
-    (33, "A2"),
-]
-list_melo_use16 = [(True, "Yes"), (False, "No")]
-list_melo_density = [(0, "less"), (2, "normal"), (4, "more")]
+# エンドレス再生で使うサウンド番号（チャンネルごとに2つを交互に使う）
+ENDLESS_SOUND = 8
+# エクスポートで使うサウンド番号（4つ）とミュージック番号（再生には使わない）
+EXPORT_SOUND = 16
+EXPORT_MUSIC = 1
+list_endless = [(False, "Off"), (True, "On")]
 
 
 # 部品
@@ -112,7 +111,7 @@ class Icon(Element):
         elif self.id == 2:
             state = 1 if app.loop else 0
         elif self.id == 3:
-            state = 1 if app.show_export else 0
+            state = 1 if app.show_export or app.exporting else 0
         px.blt(self.x, self.y, 0, self.id * 16, state * 16, self.w, self.h, 0)
         self.state = state
 
@@ -171,26 +170,33 @@ class App:
         self.output_json = "music.json"
         self.output_wav = "music.wav"
         self.output_midi = "music.mid"
-        self.failed_export_midi = False
+        self.export_job = None
         px.init(256, 256, title="8bit BGM generator", quit_key=px.KEY_NONE)
         px.load("assets.pyxres")
-        self.bdf = BDFRenderer("misaki_gothic.bdf")
+        # フォントアトラスがなければBDFを読み込む
+        if os.path.exists("misaki_gothic.atlas"):
+            self.bdf = BDFRenderer("misaki_gothic.atlas")
+        else:
+            self.bdf = BDFRenderer("misaki_gothic.bdf")
         self.parm = {
             "preset": 0,
             "transpose": 0,
             "language": 1,
             "base_highest_note": 26,  # ベース（ルート）最高音
             "melo_density": 4,  # メロディ濃度(0-4)
+            "endless": False,  # エンドレス再生
         }
         self.loop = True
-        with open("tones.json", "rt", encoding="utf-8") as fin:
-            self.tones = json.loads(fin.read())
-        with open("patterns.json", "rt", encoding="utf-8") as fin:
-            self.patterns = json.loads(fin.read())
-        with open("generator.json", "rt", encoding="utf-8") as fin:
-            self.generator = json.loads(fin.read())
-        with open("rhythm.json", "rt", encoding="utf-8") as fin:
-            self.melo_rhythm = json.loads(fin.read())
+        self.tables = load_tables()
+        self.patterns = self.tables["patterns"]
+        self.generator = self.tables["generator"]
+        # 一度聴いたパラメータの組み合わせに戻ったときは、同じシードの曲をキャッシュから出す
+        self.cache = SongCache(self.tables)
+        self.seeds = {}
+        self.composer = Composer(
+            self.parm, self.tables, cache=self.cache, compile_cache=CompileCache()
+        )
+        self.endless = None
         # タブ、共通ボタン、アイコン
         self.tabs = []
         self.buttons = []
@@ -206,9 +212,8 @@ class App:
         # 基本タブ
         for i, elm in enumerate(self.generator["preset"]):
             self.set_btn(0, "preset", i, 8 + 24 * i, 50, 24, i + 1)
-        for i in range(12):
-            key = (i + 6) % 12 - 11
-            self.set_btn(0, "transpose", key, 8 + 20 * i, 114, 20, i - 5)
+        for i, elm in enumerate(list_transpose):
+            self.set_btn(0, "transpose", elm[0], 8 + 20 * i, 114, 20, elm[1])
         for i, elm in enumerate(list_instrumentation):
             self.set_btn(0, "instrumentation", elm[0], 8, 144 + i * 10, 144, elm[1])
         # コードとリズムタブ
@@ -225,6 +230,8 @@ class App:
             self.set_btn(1, "base_quantize", elm, 8 + 24 * i, 140, 24, quantize)
         for i, elm in enumerate(self.generator["drums"]):
             self.set_btn(1, "drums", i, 8 + 24 * i, 170, 24, i + 1, 1)
+        for i, elm in enumerate(list_endless):
+            self.set_btn(1, "endless", elm[0], 8 + 24 * i, 200, 24, elm[1])
         # メロディータブ
         for i, elm in enumerate(list_tones):
             self.set_btn(2, "melo_tone", i, 8 + 24 * i, 50, 24, i + 1)
@@ -241,22 +248,17 @@ class App:
         self.play()
         self.saved_playkey = [-1, -1, -1]
         self.show_export = None
-        self.downloading = False
         self.tab = 0
         px.mouse(True)
         px.run(self.update, self.draw)
 
-    @property
-    def total_len(self):
-        return BARS_NUMBERS * 16
-
     @property
     def with_submelody(self):
-        return self.parm["instrumentation"] in (2, 3)
+        return self.composer.with_submelody
 
     @property
-    def with_drum(self):
-        return self.parm["instrumentation"] in (1, 3)
+    def exporting(self):
+        return self.export_job is not None and self.export_job.running
 
     def set_tab(self, *args):
         self.tabs.append(Tab(*args))
@@ -268,6 +270,7 @@ class App:
         self.buttons.append(Button(*args))
 
     def update(self):
+        self.update_endless()
         if not px.btnp(px.MOUSE_BUTTON_LEFT):
             return
         if self.show_export:
@@ -287,39 +290,10 @@ class App:
                     if px.play_pos(0):
                         self.play()
                 elif icon.id == 3:
-                    px.musics[0].set([0], [1], [2], [3])
                     if LOCAL:
-                        with open(
-                            f"{self.output_path}/{self.output_json}", "wt"
-                        ) as fout:
-                            fout.write(json.dumps(self.music))
-                        px.musics[0].save(f"{self.output_path}/{self.output_wav}", 1)
-                        try:
-                            sounds.make_midi(
-                                self.items, f"{self.output_path}/{self.output_midi}"
-                            )
-                        except:
-                            self.failed_export_midi = True
-                            print(
-                                "MIDIファイルを出力できませんでした。midoをインストールしてください。"
-                            )
+                        self.export_local()
                     else:
-                        if not self.downloading:
-                            self.downloading = True
-                            blob = Blob.new(
-                                [json.dumps(self.music)], {"type": "text/plain"}
-                            )
-                            blob_url = URL.createObjectURL(blob)
-                            a = document.createElement("a")
-                            a.href = blob_url
-                            a.download = self.output_json
-                            document.body.appendChild(a)
-                            a.click()
-                            document.body.removeChild(a)
-                            URL.revokeObjectURL(blob_url)
-                            px.musics[0].save(self.output_wav, 1)
-                            _savePyxelFile(self.output_wav)
-                            self.downloading = False
+                        self.export_browser()
                     self.show_export = True
                 elif icon.id == 4:
                     window.open(
@@ -330,15 +304,18 @@ class App:
                 prev_value = self.parm[button.type]
                 self.parm[button.type] = button.key
                 if button.type == "language":
+                    if prev_value != button.key:
+                        self.bdf.clear_cache()
                     return
+                # 選択中のボタンをもう一度押したら、メロディを作り直す
+                reroll = prev_value == button.key
                 if button.type == "preset":
-                    self.set_preset(button.key)
-                else:
+                    self.set_preset(button.key, reroll)
+                elif button.type != "endless":
                     make_melody = button.type in [
                         "transpose",
                         "instrumentation",
                         "chord",
-                        "base",
                         "melo_lowest_note",
                         "melo_density",
                         "melo_use16",
@@ -349,7 +326,7 @@ class App:
                             prev_value >= 0 and button.key < 0
                         ):
                             make_melody = True
-                    self.generate_music(make_melody)
+                    self.generate_music(make_melody, reroll)
                 self.play()
 
     def draw(self):
@@ -375,6 +352,7 @@ class App:
             self.text(8, 100, 11, COL_TEXT_BASIC)
             self.text(8, 130, 12, COL_TEXT_BASIC)
             self.text(8, 160, 13, COL_TEXT_BASIC)
+            self.text(8, 190, 31, COL_TEXT_BASIC)
         elif self.tab == 2:
             self.text(8, 40, 16, COL_TEXT_BASIC)
             melo_tone_name = list_tones[self.parm["melo_tone"]][1]
@@ -401,12 +379,22 @@ class App:
             px.rect(20, y + 4, 224, h, COL_SHADOW)
             px.rect(16, y, 224, h, COL_BTN_SELECTED)
             px.rectb(16, y, 224, h, COL_BTN_BASIC)
-            if self.failed_export_midi:
+            job = self.export_job
+            if self.exporting:
+                list_mes = (22, 32, 26, 27, 28)
+            elif job and job.failed:
+                list_mes = (22, 33, 26, 27, 28)
+            elif job and job.failed_midi:
                 list_mes = (22, 25, 26, 27, 28)
             else:
                 list_mes = (22, 23, 24, 27, 28)
             for i in range(5):
-                self.text(20, y + 4 + 12 * i, list_mes[i], COL_TEXT_BASIC)
+                mes = list_mes[i]
+                if mes == 32:  # 進み具合
+                    mes = f"{self.get_text(mes)[0]} {job.done}/{job.total}"
+                elif mes == 33:  # 書き出せなかったファイル
+                    mes = f"{self.get_text(mes)[0]} {job.failed_name}"
+                self.text(20, y + 4 + 12 * i, mes, COL_TEXT_BASIC)
         # 鍵盤
         sx = 8
         sy = 234
@@ -434,16 +422,20 @@ class App:
         px.rect(x1, 231, x2 - x1 + 3, 2, 10)
         # 再生インジケータ
         if px.play_pos(0):
-            pos = px.play_pos(0)[1]
+            (slot, pos) = px.play_pos(0)
             ticks = self.parm["speed"] / 16
             loc = int(pos // ticks)
             bars = loc // 16 + 1
             beats = (loc // 4) % 4 + 1
         else:
             return
-        px.text(8, 220, f"bars: {bars}/{BARS_NUMBERS}", COL_TEXT_BASIC)
+        if self.endless:
+            px.text(8, 220, f"bars: {self.endless_bar_cnt}", COL_TEXT_BASIC)
+            item = self.endless_bars[slot][0][loc % 16]
+        else:
+            px.text(8, 220, f"bars: {bars}/{BARS_NUMBERS}", COL_TEXT_BASIC)
+            item = self.items[loc]
         px.text(56, 220, f"beats: {beats}/{4}", COL_TEXT_BASIC)
-        item = self.items[loc]
         # 演奏情報
         self.draw_playkey(0, item[6], 11)
         self.draw_playkey(1, item[10], 10)
@@ -474,15 +466,103 @@ class App:
         return x, y
 
     def play(self):
+        if self.parm["endless"]:
+            self.play_endless()
+            return
+        self.endless = None
         for ch, sound in enumerate(self.music):
             px.sounds[ch].set(*sound)
             px.play(ch, ch, loop=self.loop)
 
-    def set_preset(self, value):
-        preset = self.generator["preset"][value]
-        for key in preset:
-            self.parm[key] = preset[key]
-        self.generate_music()
+    # エンドレス再生（1小節ずつ、再生していない方のサウンドに次の小節を書き込む）
+    def play_endless(self):
+        px.stop()
+        self.endless = EndlessSong(self.parm, self.tables)
+        # 再生中の小節と次の小節（再生しているサウンドの並びと同じ順）
+        self.endless_bars = [self.endless.pop_bar(), self.endless.pop_bar()]
+        self.endless_slot = 0  # 再生中の小節を入れているサウンド（0/1）
+        self.endless_bar_cnt = 1
+        for slot, bar in enumerate(self.endless_bars):
+            self.set_endless_sounds(slot, bar[1])
+        self.play_endless_bars()
+
+    def set_endless_sounds(self, slot, bar_sounds):
+        for ch, sound in enumerate(bar_sounds):
+            px.sounds[ENDLESS_SOUND + ch * 2 + slot].set(*sound)
+
+    # 再生中の小節、次の小節の順に再生する（tickを指定すると再生中の小節の途中から）
+    # Pyxelは再生を始めたときにサウンドを複製するので、書き換えた後は再生し直す必要がある
+    def play_endless_bars(self, tick=None):
+        for ch in range(4):
+            sound = ENDLESS_SOUND + ch * 2
+            slot = self.endless_slot
+            px.play(ch, [sound + slot, sound + 1 - slot], tick=tick)
+
+    # 毎フレームの先読み（1フレームで行う処理は一定量まで）
+    def update_endless(self):
+        if self.endless is None:
+            return
+        self.endless.step()
+        pos = px.play_pos(0)
+        if not pos or pos[0] == 0:
+            return
+        # 次の小節に進んだら、空いたサウンドにその次の小節を書き込んで、今の位置から再生し直す
+        (_, note_no) = pos
+        self.endless_slot = 1 - self.endless_slot
+        sound = px.sounds[ENDLESS_SOUND + self.endless_slot]
+        bar = self.endless.pop_bar()
+        self.endless_bars = [self.endless_bars[1], bar]
+        self.set_endless_sounds(1 - self.endless_slot, bar[1])
+        self.endless_bar_cnt += 1
+        self.play_endless_bars(note_no * sound.speed)
+
+    # ローカル：json/wav/midを別スレッドで書き出す（書き出し中は進み具合を表示するだけ）
+    # WAVはPyxelで書き出す。書き出し用のサウンドは再生に使わないので、書き出し中に曲を変えても影響しない
+    def export_local(self):
+        if self.exporting:
+            return
+        self.set_export_music(EXPORT_SOUND, EXPORT_MUSIC)
+        music = px.musics[EXPORT_MUSIC]
+        names = {
+            "json": self.output_json,
+            "wav": self.output_wav,
+            "midi": self.output_midi,
+        }
+        self.export_job = ExportJob(
+            self.output_path,
+            names,
+            self.composer.export(),
+            self.items,
+            lambda path: music.save(path, 1),
+        ).start()
+
+    # ブラウザ：ダウンロードはメインスレッドで行う
+    def export_browser(self):
+        blob = Blob.new(
+            [json.dumps(self.composer.export())],
+            {"type": "text/plain"},
+        )
+        blob_url = URL.createObjectURL(blob)
+        a = document.createElement("a")
+        a.href = blob_url
+        a.download = self.output_json
+        document.body.appendChild(a)
+        a.click()
+        document.body.removeChild(a)
+        URL.revokeObjectURL(blob_url)
+        self.set_export_music()
+        px.musics[0].save(self.output_wav, 1)
+        _savePyxelFile(self.output_wav)
+
+    # Pyxelで書き出すミュージック（soundから4つのサウンドに曲を入れる）
+    def set_export_music(self, sound=0, music=0):
+        for ch, data in enumerate(self.music):
+            px.sounds[sound + ch].set(*data)
+        px.musics[music].set([sound], [sound + 1], [sound + 2], [sound + 3])
+
+    def set_preset(self, value, reroll=False):
+        self.composer.set_preset(value)
+        self.generate_music(reroll=reroll)
 
     def text(self, x, y, value, c):
         if type(value) is int:
@@ -556,517 +636,26 @@ class App:
                 "それいがいは３チャンネルをつかいます。",
                 "3 channels for everything else.",
             ),
+            ("エンドレスさいせい", "Endless playback"),
+            ("　エクスポートしています…", "  Exporting..."),
+            ("　ほぞんできませんでした：", "  Failed to save:"),
         ]
         lang = self.parm["language"]
         text = list_text[value][lang]
         width = 4 if lang == 0 else 2
         return text, len(text) * width
 
-    def generate_music(self, make_melody=True):
+    # メロディに関係しないパラメータの変更では、影響するところだけ作り直す
+    def generate_music(self, make_melody=True, reroll=False):
         px.stop()
-        parm = self.parm
-        base = self.generator["base"][parm["base"]]
-        drums = self.generator["drums"][parm["drums"]]
-        # コードリスト準備
-        self.set_chord_lists()
-        # バッキング生成
-        items = []
-        self.base_notes = []
-        self.cur_chord_idx = -1
-        for loc in range(self.total_len):
-            items.append([None for _ in range(19)])
-            (chord_idx, _) = self.get_chord(loc)
-            if chord_idx > self.cur_chord_idx:
-                chord_list = self.chord_lists[chord_idx]
-                self.cur_chord_idx = chord_idx
-                self.cur_chord_loc = loc
-            item = items[loc]
-            tick = loc % 16  # 拍(0-15)
-            if loc == 0:  # 最初の行（セットアップ）
-                item[0] = parm["speed"]  # テンポ
-                item[1] = 48  # 4/4拍子
-                item[2] = 3  # 16分音符
-                item[3] = list_tones[parm["melo_tone"]][0]  # メロディ音色
-                item[4] = 6  # メロディ音量
-                item[5] = 14  # メロディ音長
-                item[7] = 7  # ベース音色
-                item[8] = 7  # ベース音量
-                item[9] = parm["base_quantize"]  # ベース音長
-                if self.with_submelody:
-                    item[11] = list_tones[parm["sub_tone"]][0]
-                    item[12] = 4
-                    item[13] = 15
-                    if self.with_drum:
-                        item[15] = 15
-                        item[16] = 5
-                        item[17] = 15
-                elif self.with_drum:
-                    item[11] = 15
-                    item[12] = 5
-                    item[13] = 15
-                else:  # リバーブ
-                    item[11] = item[3]
-                    item[12] = 2
-                    item[13] = item[5]
-
-            # ベース音設定
-            if not chord_list["repeat"] is None:
-                repeat_loc = self.chord_lists[chord_list["repeat"]]["loc"]
-                target_loc = repeat_loc + loc - self.cur_chord_loc
-                item[10] = items[target_loc][10]
-            else:
-                pattern = "basic" if loc // 16 < 7 else "final"
-                base_str = base[pattern][tick]
-                if base_str == ".":
-                    base_note = None
-                elif base_str == "0":
-                    base_note = -1
-                else:
-                    highest = parm["base_highest_note"]
-                    pattern = "basic" if loc // 16 < 7 else "final"
-                    base_root = 12 + parm["transpose"] + chord_list["base"]
-                    while base_root + 24 > highest:
-                        base_root -= 12
-                    notes = chord_list["notes_origin"]
-                    adjust_list = [0, -1, 1, -2, 2, -3, 3]
-                    adjust_idx = 0
-                    base_add = {"1": 7, "2": 12, "3": 19, "4": 24}[base_str]
-                    while notes:
-                        adjust = adjust_list[adjust_idx]
-                        base_note = base_root + base_add + adjust
-                        tmp = (base_note + parm["transpose"]) % 12
-                        # print(notes, tmp, notes[tmp])
-                        if notes[(base_note + parm["transpose"]) % 12] in [1, 2, 3]:
-                            break
-                        adjust_idx += 1
-                item[10] = base_note
-            self.base_notes.append(base_note)
-            # ドラム音設定
-            if self.with_drum:
-                pattern = "basic" if (loc // 16) % 4 < 3 else "final"
-                idx = 18 if self.with_submelody else 14
-                drum_str = drums[pattern][tick]
-                if drum_str == "0":
-                    item[idx] = None
-                else:
-                    item[idx] = ":" + drum_str
-        # メロディー生成
-        failure_cnt = 0
-        while make_melody:
-            self.generate_melody()
-            if self.check_melody():
-                break
-            failure_cnt += 1
-            self.set_chord_lists()
-            # print("--------失敗---------")
-        # print("失敗回数", failure_cnt)
-        # メロディ・サブとリバーブの音符を設定
-        for loc in range(self.total_len):
-            item = items[loc]
-            item[6] = self.melody_notes[loc]
-            if self.with_submelody:
-                item[14] = self.submelody_notes[loc]
-            elif not self.with_drum:  # リバーブ
-                item[14] = self.melody_notes[
-                    (loc + self.total_len - 1) % self.total_len
-                ]
-        # 完了処理
-        self.music = sounds.compile(items, self.tones, self.patterns)
-        self.items = items
-
-    # self.chord_listsを生成
-    def set_chord_lists(self):
-        chord = self.generator["chords"][self.parm["chord"]]
-        self.chord_lists = []
-        for progression in chord["progression"]:
-            chord_list = {
-                "loc": progression["loc"],
-                "base": 0,
-                "no_root": False,
-                "notes": [],
-                "notes_origin": [],
-                "repeat": progression["repeat"] if "repeat" in progression else None,
-            }
-            if "repeat" in progression:
-                chord_list["base"] = self.chord_lists[progression["repeat"]]["base"]
-            if "notes" in progression:
-                notes = [int(s) for s in progression["notes"]]
-                chord_list["notes_origin"] = notes
-                note_chord_cnt = 0
-                # ベース音設定
-                for idx in range(12):
-                    if notes[idx] == 2:
-                        chord_list["base"] = idx
-                    if notes[idx] in [1, 2, 3]:
-                        note_chord_cnt += 1
-                chord_list["no_root"] = note_chord_cnt > 3
-                # レンジを決める
-                if self.with_submelody:
-                    chord_list["notes"] = self.make_chord_notes(notes, SUBMELODY_DIFF)
-                else:
-                    chord_list["notes"] = self.make_chord_notes(notes)
-            self.chord_lists.append(chord_list)
-
-    # コードリストの音域設定
-    def make_chord_notes(self, notes, tone_up=0):
-        parm = self.parm
-        note_highest = None
-        idx = 0
-        results = []
-        while True:
-            note_type = int(notes[idx % 12])
-            note = 12 + idx + parm["transpose"]
-            if note >= parm["melo_lowest_note"] + tone_up:
-                if note_type in [1, 2, 3, 9]:
-                    results.append((note, note_type))
-                    if note_highest is None:
-                        note_highest = note + 15
-            if note_highest and note >= note_highest:
-                break
-            idx += 1
-        return results
-
-    # メロディ生成
-    def generate_melody(self):
-        self.melody_notes = [-2 for _ in range(self.total_len)]
-        self.submelody_notes = [-2 for _ in range(self.total_len)]
-        # メインメロディ
-        # print("=== MAIN START ===")
-        rhythm_main_list = []
-        for _ in range(5):
-            rhythm_main_list.append(self.get_rhythm_set())
-        rhythm_main_list.sort(key=len)
-        rhythm_main = rhythm_main_list[self.parm["melo_density"]]
-        for loc in range(self.total_len):
-            # すでに埋まっていたらスキップ
-            if self.melody_notes[loc] != -2:
-                continue
-            # 1セットの音を追加
-            notesets = self.get_next_notes(rhythm_main, loc)
-            if notesets is None:  # repeat
-                repeat_loc = self.chord_lists[self.chord_list["repeat"]]["loc"]
-                target_loc = repeat_loc + loc - self.cur_chord_loc
-                repeat_note = self.melody_notes[target_loc]
-                self.put_melody(loc, repeat_note, 1)
-                repeat_subnote = self.submelody_notes[target_loc]
-                self.submelody_notes[loc] = repeat_subnote
-            else:
-                notesets_len = 0
-                for noteset in notesets:
-                    self.put_melody(noteset[0], noteset[1], noteset[2])
-                    notesets_len += noteset[2]
-                self.put_submelody(loc, -2, notesets_len)
-        # サブメロディ
-        # print("=== SUB START ===")
-        rhythm_sub = self.get_rhythm_set(True)
-        prev_note_loc = -1
-        for loc in range(self.total_len):
-            note = self.submelody_notes[loc]
-            if not note is None and note >= 0:
-                prev_note_loc = loc
-                self.prev_note = note
-            elif loc - prev_note_loc >= 4 and loc % 4 == 0:
-                notesets = self.get_next_notes(rhythm_sub, loc, True)
-                if not notesets is None:
-                    for noteset in notesets:
-                        self.put_submelody(noteset[0], noteset[1], noteset[2])
-                    prev_note_loc = loc
-
-    # メロディのリズムを取得
-    def get_rhythm_set(self, is_sub=False):
-        self.cur_chord_idx = -1  # 現在のコード（self.chord_listsのインデックス）
-        self.cur_chord_loc = -1  # 現在のコードの開始位置
-        self.is_repeat = False  # リピートモード
-        self.chord_list = []
-        self.prev_note = -1  # 直前のメロディー音
-        self.first_in_chord = True  # コード切り替え後の最初のノート
-        results = []
-        used16 = False
-        while True:
-            for bar in range(BARS_NUMBERS):
-                if is_sub:
-                    pat_line = SUB_RHYTHM
-                else:
-                    while True:
-                        pat_line = self.melo_rhythm[
-                            px.rndi(0, len(self.melo_rhythm) - 1)
-                        ]
-                        # 16分音符回避設定
-                        if self.has_16th_note(pat_line):
-                            if not self.parm["melo_use16"]:
-                                continue
-                            used16 = True
-                        # 先頭が持続音のものは避ける（暫定）
-                        if not pat_line[0] is None:
-                            break
-                for idx, pat_one in enumerate(pat_line):
-                    loc = bar * 16 + idx
-                    if not pat_one is None:
-                        results.append((loc, pat_one))
-            if is_sub or not self.parm["melo_use16"] or used16:
-                break
-        for _ in range(2):
-            results.append((self.total_len, -1))
-        return results
-
-    # 16分音符が含まれるか
-    def has_16th_note(self, line):
-        prev_str = None
-        for i in line:
-            if i == 0 and prev_str == 0:
-                return True
-            prev_str = i
-        return False
-
-    def get_next_notes(self, rhythm_set, loc, is_sub=False):
-        pat = None
-        for pat_idx, rhythm in enumerate(rhythm_set):
-            if loc == rhythm[0]:
-                pat = rhythm[1]
-                break
-            elif loc < rhythm[0]:
-                break
-        note_len = rhythm_set[pat_idx + 1][0] - loc
-        # コード切替判定
-        change_code = False
-        premonitory = False
-        (next_chord_idx, next_chord_loc) = self.get_chord(loc)
-        if next_chord_idx > self.cur_chord_idx:
-            change_code = True
-        elif not self.is_repeat and loc + note_len > next_chord_loc:
-            (next_chord_idx, next_chord_loc) = self.get_chord(loc + note_len)
-            change_code = True
-            premonitory = True
-            # print(loc, note_len, "先取音発生")
-        if change_code:
-            self.chord_list = self.chord_lists[next_chord_idx]
-            self.cur_chord_idx = next_chord_idx
-            self.cur_chord_loc = loc
-            self.first_in_chord = True
-            self.is_repeat = not self.chord_list["repeat"] is None
-        # 小節単位の繰り返し
-        if self.is_repeat:
-            # print(loc, "repeat")
-            return [] if premonitory else None
-        if pat == -1:  # 休符
-            # print(loc, "休符")
-            return [(loc, -1, note_len)]
-        # 初期処理
-        self.chord_notes = self.chord_list["notes"]
-        next_idx = self.get_target_note(is_sub, loc)
-        # 連続音を何個置けるか（コード維持＆４分音符以下）
-        following = []
-        prev_loc = loc
-        while True:
-            pat_loc = rhythm_set[pat_idx + 1 + len(following)][0]
-            no_next = pat_loc >= next_chord_loc or pat_loc - prev_loc > 4
-            if not following or not no_next:
-                following.append((prev_loc, pat_loc - prev_loc))
-            if no_next:
-                break
-            prev_loc = pat_loc
-        loc, note_len = following[0]
-        # 直前のメロディーのインデックスを今のコードリストと照合(構成音から外れていたらNone)
-        cur_idx = None
-        if not premonitory:
-            for idx, note in enumerate(self.chord_notes):
-                if self.prev_note == note[0]:
-                    cur_idx = idx
-                    break
-        # 初音（直前が休符 or コード構成音から外れた場合は、コード構成音を取得）
-        if self.prev_note < 0 or cur_idx is None:
-            # print(loc, "初音")
-            note = self.chord_notes[next_idx][0]
-            return [(loc, note, note_len)]
-        # 各種変数準備
-        results = []
-        diff = abs(next_idx - cur_idx)
-        direction = 1 if next_idx > cur_idx else -1
-        # 刺繍音/同音
-        if diff == 0:
-            cnt = len(following) // 2
-            if cnt and px.rndi(0, 1) and not is_sub:
-                # print(loc, "刺繍音", cnt * 2)
-                for i in range(cnt):
-                    while next_idx == cur_idx:
-                        next_idx = self.get_target_note()
-                    direction = 1 if next_idx > cur_idx else -1
-                    # print(cur_idx, next_idx, self.chord_notes)
-                    note = self.chord_notes[cur_idx + direction][0]
-                    prev_note = self.prev_note
-                    note_follow = following[i * 2]
-                    results.append((note_follow[0], note, note_follow[1]))
-                    note_follow = following[i * 2 + 1]
-                    results.append((note_follow[0], prev_note, note_follow[1]))
-                return results
-            else:
-                # print(loc, "同音")
-                return [(loc, self.prev_note, note_len)]
-        # ステップに必要な長さが足りない/跳躍量が大きい/割合で跳躍音採用
-        if abs(next_idx - cur_idx) > len(following):
-            note = self.chord_notes[next_idx][0]
-            # print(loc, "跳躍")
-            return [(loc, note, note_len)]
-        # ステップ
-        # print(loc, "ステップ", abs(next_idx - cur_idx))
-        i = 0
-        while next_idx != cur_idx:
-            cur_idx += direction
-            note = self.chord_notes[cur_idx][0]
-            note_follow = following[i]
-            results.append((note_follow[0], note, note_follow[1]))
-            i += 1
-        return results
-
-    # メロディ検査（コード中の重要構成音が入っているか）
-    def check_melody(self):
-        cur_chord_idx = -1
-        need_notes_list = []
-        for loc in range(self.total_len):
-            (next_chord_idx, _) = self.get_chord(loc)
-            if next_chord_idx > cur_chord_idx:
-                # need_notes_listが残っている＝重要構成音が満たされていない
-                if len(need_notes_list) > 0:
-                    return False
-                cur_chord_idx = next_chord_idx
-                notes_list = self.chord_lists[cur_chord_idx]["notes"]
-                need_notes_list = []
-                for chord in notes_list:
-                    note = chord[0] % 12
-                    if chord[1] == 1 and not note in need_notes_list:
-                        need_notes_list.append(note)
-            note = self.melody_notes[loc]
-            if not note is None and note >= 0 and note % 12 in need_notes_list:
-                need_notes_list.remove(note % 12)
-            if self.with_submelody:
-                note = self.submelody_notes[loc]
-                if not note is None and note >= 0 and note % 12 in need_notes_list:
-                    need_notes_list.remove(note % 12)
-        return True
-
-    # コードリスト取得（locがchords_listsの何番目のコードか、次のコードの開始位置を返す）
-    def get_chord(self, loc):
-        chord_lists_cnt = len(self.chord_lists)
-        next_chord_loc = 16 * BARS_NUMBERS
-        for rev_idx in range(chord_lists_cnt):
-            idx = chord_lists_cnt - rev_idx - 1
-            if loc >= self.chord_lists[idx]["loc"]:
-                break
-            else:
-                next_chord_loc = self.chord_lists[idx]["loc"]
-        return idx, next_chord_loc
-
-    # 跳躍音の跳躍先を決定
-    def get_target_note(self, is_sub=False, loc=None):
-        no_root = self.first_in_chord or self.chord_list["no_root"]
-        allowed_types = [1, 3] if no_root else [1, 2, 3]
-        notes = self.get_subnotes(loc) if is_sub else self.chord_list["notes"]
-        # 跳躍先候補が1オクターブ超のみの場合、最低音を選択
-        hightest_note = 0
-        hightest_idx = 0
-        for idx, noteset in enumerate(notes):
-            if noteset[0] > hightest_note and noteset[1] in allowed_types:
-                hightest_note = noteset[0]
-                hightest_idx = idx
-        if self.prev_note - hightest_note > 12:
-            return hightest_idx
-        while True:
-            idx = px.rndi(0, len(notes) - 1)
-            if not notes[idx][1] in allowed_types:
-                continue
-            note = notes[idx][0]
-            if self.prev_note >= 0:
-                diff = abs(self.prev_note - note)
-                if diff > 12:
-                    continue
-                factor = diff if diff != 12 else diff - 6
-                # 近い音ほど出やすい（オクターブ差は補正、サブはそうではない）
-                if px.rndi(0, 15) < factor and not is_sub:
-                    continue
-            return idx
-
-    # メロディのトーンを配置
-    def put_melody(self, loc, note, note_len=1):
-        for idx in range(note_len):
-            self.melody_notes[loc + idx] = note if idx == 0 else None
-        if note is not None:
-            self.prev_note = note
-            self.first_in_chord = False
-
-    # サブメロディのトーンを配置
-    def put_submelody(self, loc, note, note_len=1):
-        master_note = None
-        subnote = note
-        master_loc = loc
-        while master_loc >= 0:
-            master_note = self.melody_notes[master_loc]
-            if not master_note is None and master_note >= 0:
-                prev_note = master_note if note == -2 else note
-                subnote = self.search_downer_note(prev_note, master_note, master_loc)
-                break
-            master_loc -= 1
-        prev_subnote = None
-        for idx in range(note_len):
-            if (
-                not self.melody_notes[loc + idx] is None
-                and self.melody_notes[loc + idx] >= 0
-            ):
-                master_note = self.melody_notes[loc + idx]
-            duplicate = (
-                not master_note is None
-                and not subnote is None
-                and (abs(subnote > master_note) < 3)
-            )
-            if duplicate:
-                subnote = self.search_downer_note(subnote, master_note, loc + idx)
-            self.submelody_notes[loc + idx] = (
-                subnote if subnote != prev_subnote else None
-            )
-            prev_subnote = subnote
-
-    # メロの下ハモを探す
-    def search_downer_note(self, prev_note, master_note, loc):
-        if self.with_submelody and master_note >= 0:
-            notes = self.get_subnotes(loc)
-            if not prev_note is None and abs(prev_note - master_note) >= 3:
-                return prev_note
-            cur_note = master_note - 3
-            while cur_note >= self.parm["melo_lowest_note"]:
-                for n in notes:
-                    if n[0] == cur_note and n[1] in [1, 2, 3]:
-                        return cur_note
-                cur_note -= 1
-        return -1
-
-    # サブパートの許容音域を取得
-    def get_subnotes(self, start_loc):
-        master_note = None
-        base_note = None
-        loc = start_loc
-        while master_note is None or base_note is None:
-            if master_note is None and self.melody_notes[loc] != -1:
-                master_note = self.melody_notes[loc]
-            if base_note is None and self.base_notes[loc] != -1:
-                base_note = self.base_notes[loc]
-            loc = (loc + self.total_len - 1) % self.total_len
-        notes = self.chord_list["notes_origin"].copy()
-        results = []
-        has_important_tone = False
-        idx = 0
-        while notes:
-            note_type = notes[idx % 12]
-            if note_type in [1, 2, 3, 9]:
-                note = 12 + idx + self.parm["transpose"]
-                # ベース+3〜メイン-3までを許可する
-                if note > master_note - 3 and has_important_tone:
-                    break
-                if note >= base_note + 3:
-                    results.append((note, note_type))
-                    if note_type in [1, 3]:
-                        has_important_tone = True
-            idx += 1
-        self.chord_notes = results
-        return results
+        parm_key = self.cache.parm_key(self.parm)
+        if make_melody:
+            seed = None if reroll else self.seeds.get(parm_key)
+            self.items, self.music = self.composer.generate_music(True, seed)
+        else:
+            self.items, self.music = self.composer.update_music()
+        self.seeds[parm_key] = self.composer.seed
 
 
-App()
+if __name__ == "__main__":
+    App()
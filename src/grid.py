@@ -0,0 +1,113 @@
+from array import array
+
+# 行データ（1行が19列のリスト）をまとめて持つ、列ごとの整数配列
+# 列の並び：0テンポ 1拍子 2音長 / チャンネルごとに 音色・音量・音長・ノート
+# （メロディ3〜6、ベース7〜10、サブ11〜14、ドラム15〜18）
+ITEM_COLUMNS = 19
+
+# 値がない（前の行から変わらない）ことを表す値
+NONE_VALUE = -32768
+# ドラム（":1"など）は DRUM_BASE - 文字コード で表す（普通の値はこれより大きい）
+DRUM_BASE = -16384
+
+
+def encode_value(value):
+    if value is None:
+        return NONE_VALUE
+    if isinstance(value, str):
+        if len(value) != 2 or value[0] != ":":
+            raise ValueError(f"unknown drum key: {value}")
+        return DRUM_BASE - ord(value[1])
+    if value <= DRUM_BASE or value > 32767:
+        raise ValueError(f"value out of range: {value}")
+    return value
+
+
+def decode_value(code):
+    if code == NONE_VALUE:
+        return None
+    if code <= DRUM_BASE:
+        return ":" + chr(DRUM_BASE - code)
+    return code
+
+
+# 1曲分の行データ（行ごとのリストの代わりに、列ごとに並べた16bit整数の配列1つで持つ）
+# grid[行][列]で元の行データと同じ値が読めるので、そのまま行データとして渡せる
+class SongGrid:
+    def __init__(self, rows, data):
+        self.rows = rows
+        self.data = data
+
+    @classmethod
+    def from_items(cls, items):
+        rows = len(items)
+        data = array("h", bytes(2 * rows * ITEM_COLUMNS))
+        for row, item in enumerate(items):
+            for col in range(ITEM_COLUMNS):
+                data[col * rows + row] = encode_value(item[col])
+        return cls(rows, data)
+
+    def __len__(self):
+        return self.rows
+
+    def __getitem__(self, row):
+        if isinstance(row, slice):
+            return [GridRow(self, r) for r in range(*row.indices(self.rows))]
+        if row < 0:
+            row += self.rows
+        if not 0 <= row < self.rows:
+            raise IndexError("row index out of range")
+        return GridRow(self, row)
+
+    def __iter__(self):
+        for row in range(self.rows):
+            yield GridRow(self, row)
+
+    # 1列分の値（エンコードしたまま、コピーしない）
+    def column(self, col):
+        return memoryview(self.data)[col * self.rows : (col + 1) * self.rows]
+
+    def get(self, row, col):
+        return decode_value(self.data[col * self.rows + row])
+
+    # 行ごとのリスト（元の行データ）に戻す
+    def to_items(self):
+        columns = [
+            [decode_value(code) for code in self.column(col)]
+            for col in range(ITEM_COLUMNS)
+        ]
+        return [list(item) for item in zip(*columns)]
+
+    @property
+    def nbytes(self):
+        return self.data.itemsize * len(self.data)
+
+
+# SongGridの1行（値は読むときに元の形に戻す）
+class GridRow:
+    __slots__ = ("grid", "row")
+
+    def __init__(self, grid, row):
+        self.grid = grid
+        self.row = row
+
+    def __len__(self):
+        return ITEM_COLUMNS
+
+    def __getitem__(self, col):
+        if isinstance(col, slice):
+            return [
+                self.grid.get(self.row, c) for c in range(*col.indices(ITEM_COLUMNS))
+            ]
+        if col < 0:
+            col += ITEM_COLUMNS
+        if not 0 <= col < ITEM_COLUMNS:
+            raise IndexError("column index out of range")
+        return self.grid.get(self.row, col)
+
+    def __iter__(self):
+        for col in range(ITEM_COLUMNS):
+            yield self.grid.get(self.row, col)
+
+    def copy(self):
+        return list(self)
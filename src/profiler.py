@@ -0,0 +1,72 @@
+import json
+import time
+from contextlib import contextmanager, nullcontext
+
+
+# 生成処理の計測（ステージごとの経過時間と、リトライ回数などのカウンタ）
+class Profiler:
+    def __init__(self):
+        self.stages = {}  # ステージ名: [呼び出し回数, 合計秒]
+        self.counters = {}
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            record = self.stages.setdefault(name, [0, 0.0])
+            record[0] += 1
+            record[1] += time.perf_counter() - start
+
+    def count(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def reset(self):
+        self.stages = {}
+        self.counters = {}
+
+    # 別プロセスなどで計測した結果（to_dictの出力）を合算
+    def merge(self, data):
+        for name, stage in data["stages"].items():
+            record = self.stages.setdefault(name, [0, 0.0])
+            record[0] += stage["calls"]
+            record[1] += stage["total_ms"] / 1000
+        for name, value in data["counters"].items():
+            self.count(name, value)
+
+    def to_dict(self):
+        return {
+            "stages": {
+                name: {"calls": calls, "total_ms": total * 1000}
+                for name, (calls, total) in self.stages.items()
+            },
+            "counters": dict(self.counters),
+        }
+
+    def to_json(self, **kwargs):
+        return json.dumps(self.to_dict(), **kwargs)
+
+    def summary(self):
+        lines = [f"{'stage':<16}{'calls':>10}{'total ms':>12}{'avg ms':>10}"]
+        for name, (calls, total) in self.stages.items():
+            avg = total * 1000 / calls if calls else 0
+            lines.append(f"{name:<16}{calls:>10}{total * 1000:>12.2f}{avg:>10.3f}")
+        if self.counters:
+            lines.append("")
+            lines.append(f"{'counter':<26}{'value':>12}")
+            for name, value in self.counters.items():
+                lines.append(f"{name:<26}{value:>12}")
+        return "\n".join(lines)
+
+
+# 計測しないときに使う（何もしない）
+class NullProfiler:
+    def stage(self, name):
+        return nullcontext()
+
+    def count(self, name, value=1):
+        pass
+
+
+NULL_PROFILER = NullProfiler()
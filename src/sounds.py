@@ -1,21 +1,36 @@
 import sys
 import math
+import struct
+import zipfile
+from collections import OrderedDict, deque
+from profiler import NULL_PROFILER
 
 try:
-    import mido
-    from mido import MidiFile, MidiTrack, Message, MetaMessage
-except:
-    pass
+    import numpy as np
+except ImportError:
+    np = None
 
 list_notes = ("c", "c#", "d", "d#", "e", "f", "f#", "g", "g#", "a", "a#", "b")
 
+# MIDIファイルの分解能（4分音符の長さ）
+MIDI_TICKS_PER_BEAT = 480
+# ドラムのノート（Pyxelのドラムパターン → GMのドラム音色）
+MIDI_DRUMS = {":1": 36, ":2": 38, ":3": 42, ":5": 45, ":6": 47, ":7": 50}
 
-def putNotes(note_len, state, tones, result):
-    if len(result.keys()) == 0:
-        result["note"] = ""
-        result["tone"] = ""
-        result["volume"] = ""
-        result["effect"] = ""
+# これより短い区間はNumPyを使わずに計算する（配列を作るコストの方が大きいため）
+NUMPY_MIN_TICKS = 16
+# チャンネルごとのコンパイル結果をいくつまで覚えておくか
+COMPILE_CACHE_SIZE = 256
+
+
+# stateの状態からloops個分の音を生成（note/tone/volume/effectの文字列を返す）
+def render_ticks(note_len, state, tones, loops):
+    if np is None or loops < NUMPY_MIN_TICKS:
+        return _render_ticks_py(note_len, state, tones, loops)
+    return _render_ticks_np(note_len, state, tones, loops)
+
+
+def _render_ticks_py(note_len, state, tones, loops):
     tone = tones[state["tone"]]
     pattern = state["pattern"]
     decay = pattern["decay"] if pattern and "decay" in pattern else tone["decay"]
@@ -23,7 +38,9 @@ def putNotes(note_len, state, tones, result):
         pattern["sustain"] if pattern and "sustain" in pattern else tone["sustain"]
     )
     velocity = pattern["velocity"] / 100 if pattern else 1.0
-    loops = int((note_len + state["tick"]) / 48) - int(state["tick"] / 48)
+    note_strs = []
+    volumes = []
+    effects = []
     for _ in range(loops):
         level = 0
         state["duration"] += 1
@@ -63,14 +80,194 @@ def putNotes(note_len, state, tones, result):
         vibrato = tone["vibrato"] if "vibrato" in tone else 0
         effect = "n" if vibrato == 0 or duration < vibrato or skipVib else "v"
         volume = min(math.ceil(level * state["volume"] * velocity), 7)
-        result["note"] += note_str
-        result["tone"] += pattern["wave"] if pattern else tone["wave"]
-        result["volume"] += str(volume)
-        result["effect"] += effect
+        note_strs.append(note_str)
+        volumes.append(str(volume))
+        effects.append(effect)
+    wave = pattern["wave"] if pattern else tone["wave"]
+    return "".join(note_strs), wave * loops, "".join(volumes), "".join(effects)
+
+
+# _render_ticks_pyと同じ結果をNumPyでまとめて計算する
+def _render_ticks_np(note_len, state, tones, loops):
+    tone = tones[state["tone"]]
+    pattern = state["pattern"]
+    decay = pattern["decay"] if pattern and "decay" in pattern else tone["decay"]
+    sustain = (
+        pattern["sustain"] if pattern and "sustain" in pattern else tone["sustain"]
+    )
+    velocity = pattern["velocity"] / 100 if pattern else 1.0
+    attack = tone["attack"]
+    release = tone["release"] if "release" in tone else 0
+    ticks = np.arange(loops)
+    durations = state["duration"] + 1 + ticks
+    # 発音中のtick数（クオンタイズを超えたら休符=リリースに切り替わる）
+    switched = False
+    if state["is_rest"]:
+        sounding = 0
+    else:
+        limit = note_len / 48 * state["note_cnt"] * state["quantize"]
+        sounding = int(np.count_nonzero(durations <= limit))
+        # 切り替わったtickはduration=1、stateには0が入るので次のtickも1から数える
+        durations[sounding:] = ticks[sounding:] - sounding
+        if sounding < loops:
+            durations[sounding] = 1
+            switched = sounding == loops - 1
+    is_rest = ticks >= sounding
+    # 音量
+    levels = np.zeros(loops)
+    active = ~is_rest
+    if attack:
+        mask = active & (durations < attack)
+        levels[mask] = durations[mask] / attack
+    mask = active & (durations >= attack) & (durations < attack + decay)
+    levels[mask] = 1 - (1 - sustain / 100) * ((durations[mask] - attack) / decay)
+    mask = active & (durations >= attack + decay)
+    levels[mask] = sustain / 100
+    if release:
+        mask = is_rest & (durations < release)
+        levels[mask] = sustain / 100 * (1 - durations[mask] / release)
+    volumes = np.minimum(np.ceil(levels * state["volume"] * velocity), 7)
+    # 音程
+    if pattern:
+        notes = pattern["notes"]
+        indexes = np.minimum(durations, len(notes)) - 1
+        note_list = [notes[idx] for idx in indexes.tolist()]
+        state["note"] = note_list[-1]
+        note_str = "".join([note_name(note) for note in note_list])
+    else:
+        released = np.flatnonzero(is_rest & (durations >= release))
+        cnt = int(released[0]) if len(released) else loops
+        note = state["note"]
+        if note is None or note < 0:
+            note_str = "r" * loops
+        else:
+            note_str = note_name(note) * cnt + "r" * (loops - cnt)
+        if len(released):
+            state["note"] = -1
+    # エフェクト（ビブラート）
+    vibrato = tone["vibrato"] if "vibrato" in tone else 0
+    if vibrato == 0:
+        effect_str = "n" * loops
+    else:
+        vib = durations >= vibrato
+        if tone["wave"] in ["S", "T"]:
+            vib &= durations % 2 == 0
+        effect_str = np.where(vib, 118, 110).astype(np.uint8).tobytes().decode()
+    state["duration"] = 0 if switched else int(durations[-1])
+    state["is_rest"] = bool(is_rest[-1])
+    wave = pattern["wave"] if pattern else tone["wave"]
+    volume_str = (volumes + 48).astype(np.uint8).tobytes().decode()
+    return note_str, wave * loops, volume_str, effect_str
+
+
+def note_name(note):
+    return list_notes[note % 12] + str(note // 12)
+
+
+# チャンネルごとのコンパイル結果のキャッシュ
+# テンポ・音長（0、2列目）とそのチャンネルの4列が同じなら、同じサウンドになる
+class CompileCache:
+    def __init__(self, maxsize=COMPILE_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.tables = None
+        self.hits = 0
+        self.misses = 0
+
+    # 音色データが変わったら、それまでの結果は使えない
+    def use_tables(self, tones, patterns):
+        if self.tables is None or self.tables[0] is not tones:
+            self.entries.clear()
+        elif self.tables[1] is not patterns:
+            self.entries.clear()
+        self.tables = (tones, patterns)
+
+    def make_key(self, src, ch):
+        idx = 3 + ch * 4
+        return ch, tuple(
+            (item[0], item[2], item[idx], item[idx + 1], item[idx + 2], item[idx + 3])
+            for item in src
+        )
+
+    # キャッシュにあればサウンド（音がなければNone）、なければdefaultを返す
+    def get(self, key, default=None):
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return self.entries[key]
+        self.misses += 1
+        return default
+
+    def put(self, key, sound):
+        self.entries[key] = sound
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0,
+            "size": len(self.entries),
+            "maxsize": self.maxsize,
+        }
 
 
 # Pyxel再生データの生成
-def compile(src, tones, patterns):
+# channelsを指定するとそのチャンネルだけを生成する（それ以外はNone）
+# cache（CompileCache）を指定すると、変わっていないチャンネルは前の結果を使う
+def compile(src, tones, patterns, profiler=NULL_PROFILER, channels=None, cache=None):
+    channels = list(range(4)) if channels is None else sorted(channels)
+    sounds = [None, None, None, None]
+    keys = {}
+    if cache is not None:
+        cache.use_tables(tones, patterns)
+        for ch in channels:
+            keys[ch] = cache.make_key(src, ch)
+            sounds[ch] = cache.get(keys[ch], False)
+        channels = [ch for ch in channels if sounds[ch] is False]
+        profiler.count("compile_cache_hits", len(keys) - len(channels))
+    if not channels:
+        return sounds
+    results = [([], [], [], []) for _ in range(4)]
+    for chunk in render_chunks(src, tones, patterns, None, profiler, channels):
+        for ch in channels:
+            for result, value in zip(results[ch], chunk[ch]):
+                result.append(value)
+    with profiler.stage("shorten"):
+        for ch in channels:
+            sounds[ch] = make_sound(*["".join(value) for value in results[ch]])
+            if cache is not None:
+                cache.put(keys[ch], sounds[ch])
+    return sounds
+
+
+# chunk_rows行ごとにPyxelのサウンド（チャンネルごと、音がなければNone）を返す
+# 長い曲でも先頭から順に再生・保存できる（つなげるとcompileの結果と同じ音になる）
+def iter_compile(src, tones, patterns, chunk_rows=16, profiler=NULL_PROFILER):
+    for chunk in render_chunks(src, tones, patterns, chunk_rows, profiler):
+        yield [make_sound(*sound) for sound in chunk]
+
+
+def make_sound(note, tone, volume, effect):
+    if not note:
+        return None
+    return [note, shorten(tone), shorten(volume), shorten(effect), 1]
+
+
+# 行データを先頭から処理して、chunk_rows行ごと（Noneなら最後にまとめて）に
+# チャンネルごとの(note, tone, volume, effect)文字列を返す
+# srcはイテレータでもよい（ノートの長さが決まるまで、同じチャンネルの次のノートまで先読みする）
+def render_chunks(
+    src, tones, patterns, chunk_rows=None, profiler=NULL_PROFILER, channels=None
+):
+    # チャンネル同士はテンポ・音長（0、2列目）以外は独立しているので、一部だけでも生成できる
+    channels = range(4) if channels is None else sorted(channels)
     speed = 240
     note_len = 48
     states = []
@@ -89,17 +286,40 @@ def compile(src, tones, patterns):
                 "tick": 0,
             }
         )
-        results.append({})
-    for row, item in enumerate(src):
+        results.append(([], [], [], []))
+    # 音色キー→パターン（同じキーは後のものを優先）
+    pattern_map = {pattern["key"]: pattern for pattern in patterns}
+    # 状態が変わらない行はまとめて（区間ごとに）音を生成する
+    pending = [0, 0, 0, 0]
+    loops = 0
+    # 先読みした行と、ノートの行→次のノートまでの行数
+    buffer = deque()
+    note_cnts = [{}, {}, {}, {}]
+    open_rows = [None, None, None, None]  # 長さがまだ決まらないノートの行
+
+    def flush(ch):
+        if pending[ch]:
+            sound = render_ticks(note_len, states[ch], tones, pending[ch])
+            for result, value in zip(results[ch], sound):
+                result.append(value)
+            pending[ch] = 0
+
+    def process(row, item):
+        nonlocal speed, note_len, loops
+        if not item[0] is None or not item[2] is None:
+            for ch in channels:
+                flush(ch)
         if not item[0] is None:
             old_speed = speed
             speed = item[0]
             note_len = note_len / old_speed * speed
         if not item[2] is None:
             note_len = speed * item[2]
-        for ch in range(4):
+        for ch in channels:
             state = states[ch]
             item_idx = 3 + ch * 4
+            if any(not item[item_idx + i] is None for i in range(4)):
+                flush(ch)
             if not item[item_idx] is None:
                 state["tone"] = item[item_idx]
             if not item[item_idx + 1] is None:
@@ -108,48 +328,120 @@ def compile(src, tones, patterns):
                 state["quantize"] = item[item_idx + 2] / 16
             note = item[item_idx + 3]
             if not note is None:
-                state["pattern"] = None
-                for pattern in patterns:
-                    if pattern["key"] == note:
-                        state["pattern"] = pattern
+                state["pattern"] = pattern_map.get(note)
                 state["duration"] = 0
                 if note == -1:
                     state["is_rest"] = True
                 else:
                     state["is_rest"] = False
                     state["note"] = note if state["pattern"] is None else None
-                note_cnt = 0
-                while True:
-                    note_cnt += 1
-                    if row + note_cnt >= len(src):
-                        break
-                    nextItem = src[row + note_cnt]
-                    if not nextItem[item_idx + 3] is None:
-                        break
-                state["note_cnt"] = note_cnt
-            putNotes(note_len, state, tones, results[ch])
+                state["note_cnt"] = note_cnts[ch].pop(row)
+            tick = state["tick"]
+            row_loops = int((note_len + tick) / 48) - int(tick / 48)
+            pending[ch] += row_loops
+            loops += row_loops
             state["tick"] += note_len
-    sounds = []
+
+    def take_chunk():
+        chunk = []
+        for ch in range(4):
+            flush(ch)
+            chunk.append(tuple("".join(result) for result in results[ch]))
+            for result in results[ch]:
+                result.clear()
+        return chunk
+
+    done = 0
+    row = -1
+    for row, item in enumerate(src):
+        for ch in channels:
+            if not item[6 + ch * 4] is None:
+                if not open_rows[ch] is None:
+                    note_cnts[ch][open_rows[ch]] = row - open_rows[ch]
+                open_rows[ch] = row
+        buffer.append((row, item))
+        # 長さが決まっていないノートより前の行まで処理できる
+        limit = min([r for r in open_rows if not r is None], default=row + 1)
+        while buffer and buffer[0][0] < limit:
+            process(*buffer.popleft())
+            done += 1
+            if chunk_rows and done % chunk_rows == 0:
+                yield take_chunk()
     for ch in range(4):
-        sound = results[ch]
-        if sound["note"]:
-            sounds.append(
-                [
-                    sound["note"],
-                    shorten(sound["tone"]),
-                    shorten(sound["volume"]),
-                    shorten(sound["effect"]),
-                    1,
-                ]
-            )
-        else:
-            sounds.append(None)
-    return sounds
+        if not open_rows[ch] is None:
+            note_cnts[ch][open_rows[ch]] = row + 1 - open_rows[ch]
+    while buffer:
+        process(*buffer.popleft())
+        done += 1
+        if chunk_rows and done % chunk_rows == 0:
+            yield take_chunk()
+    profiler.count("render_loops", loops)
+    if not chunk_rows or done % chunk_rows:
+        yield take_chunk()
 
 
-# Pyxel再生データの生成
+# MIDIファイルの生成（outPathにはファイルパスかバイナリのファイルオブジェクトを指定）
 def make_midi(src, outPath):
-    mid = MidiFile()
+    data = make_midi_bytes(src)
+    if isinstance(outPath, str):
+        with open(outPath, "wb") as fout:
+            fout.write(data)
+    else:
+        outPath.write(data)
+
+
+# 複数の曲（ファイル名, 行データ）をまとめて1つのzipに書き出す
+# 行データの代わりにmake_midi_bytesで作ったバイト列を渡してもよい
+def make_midi_archive(songs, outPath):
+    with zipfile.ZipFile(outPath, "w", zipfile.ZIP_DEFLATED) as archive:
+        for name, src in songs:
+            data = src if isinstance(src, bytes) else make_midi_bytes(src)
+            archive.writestr(name, data)
+
+
+# 可変長数値（デルタタイム）
+def encode_varlen(value):
+    buf = bytearray((value & 0x7F,))
+    value >>= 7
+    while value:
+        buf.insert(0, (value & 0x7F) | 0x80)
+        value >>= 7
+    return buf
+
+
+# 1トラック分のイベントをバイト列に直接書き込む（同じステータスが続けば省略する）
+class MidiTrackWriter:
+    def __init__(self):
+        self.data = bytearray()
+        self.status = None
+
+    def add_event(self, time, status, *values):
+        if time < 0:
+            raise ValueError("message time must be non-negative in MIDI file")
+        self.data += encode_varlen(time)
+        if status != self.status:
+            self.data.append(status)
+            self.status = status
+        self.data.extend(values)
+
+    def add_tempo(self, time, tempo):
+        self.data += encode_varlen(time)
+        self.data += b"\xff\x51\x03" + tempo.to_bytes(3, "big")
+        self.status = None
+
+    def to_bytes(self):
+        data = self.data + b"\x00\xff\x2f\x00"  # トラック終端
+        return b"MTrk" + len(data).to_bytes(4, "big") + data
+
+
+def bpm_to_tempo(bpm):
+    return int(round(60 * 1e6 / bpm))
+
+
+# 行データからMIDIファイル（フォーマット1）のバイト列を作る
+# 1トラック目はテンポだけのトラックで、テンポが変わった行でset_tempoを入れる
+def make_midi_bytes(src):
+    conductor = MidiTrackWriter()
     tracks = [None, None, None, None]
     has_note = [False, False, False, False]
     tones = [None, None, None, None]
@@ -158,56 +450,27 @@ def make_midi(src, outPath):
     rest_time = [0, 0, 0, 0]
     volumes = [7, 7, 7, 7]
     quantize = [15, 15, 15, 15]
-    bpm = 120
+    tempo = None
     note_len = 480
+    cur_time = 0  # 曲の先頭からの時間
+    tempo_time = 0  # 最後にテンポを入れた時間
 
     def make_track(ch):
         if tracks[ch] is None:
-            tracks[ch] = MidiTrack()
-            tracks[ch].append(MetaMessage("set_tempo", tempo=bpm))
+            tracks[ch] = MidiTrackWriter()
 
     def put_note(ch, new_note):
         make_track(ch)
+        track = tracks[ch]
         note = notes[ch]
         if note_time[ch] and note != -1:
             midi_time = (note_time[ch] * quantize[ch]) // 16
-            tracks[ch].append(
-                Message(
-                    "note_off",
-                    note=note,
-                    velocity=64,
-                    time=midi_time,
-                    channel=ch,
-                )
-            )
+            track.add_event(midi_time, 0x80 | ch, note, 64)
             rest_time[ch] = note_time[ch] - midi_time
         if type(new_note) is str and new_note[0] == ":":
-            midi_note = {
-                ":1": 36,
-                ":2": 38,
-                ":3": 42,
-                ":5": 45,
-                ":6": 47,
-                ":7": 50,
-            }[new_note]
-            tracks[ch].append(
-                Message(
-                    "note_on",
-                    note=midi_note,
-                    velocity=volumes[ch] * 16,
-                    time=rest_time[ch],
-                    channel=9,
-                )
-            )
-            tracks[ch].append(
-                Message(
-                    "note_off",
-                    note=midi_note,
-                    velocity=64,
-                    time=40,
-                    channel=9,
-                )
-            )
+            midi_note = MIDI_DRUMS[new_note]
+            track.add_event(rest_time[ch], 0x99, midi_note, volumes[ch] * 16)
+            track.add_event(40, 0x89, midi_note, 64)
             has_note[ch] = True
             rest_time[ch] = -40
             notes[ch] = -1
@@ -215,23 +478,18 @@ def make_midi(src, outPath):
             notes[ch] = -1
         else:
             midi_note = 36 + new_note
-            tracks[ch].append(
-                Message(
-                    "note_on",
-                    note=midi_note,
-                    velocity=volumes[ch] * 16,
-                    time=rest_time[ch],
-                    channel=ch,
-                )
-            )
+            track.add_event(rest_time[ch], 0x90 | ch, midi_note, volumes[ch] * 16)
             has_note[ch] = True
             notes[ch] = midi_note
         note_time[ch] = 0
 
     for item in src:
         if not item[0] is None:
-            # TODO:テンポ変更はいったん考慮しない
-            bpm = mido.bpm2tempo(28800 // item[0])
+            new_tempo = bpm_to_tempo(28800 // item[0])
+            if new_tempo != tempo:
+                conductor.add_tempo(cur_time - tempo_time, new_tempo)
+                tempo = new_tempo
+                tempo_time = cur_time
         if not item[2] is None:
             note_len = item[2] * 40
         for ch in range(4):
@@ -241,7 +499,7 @@ def make_midi(src, outPath):
                 tone = item[idx + 3]
                 tones[ch] = tone
                 if tone != 15:
-                    tracks[ch].append(Message("program_change", program=6, channel=ch))
+                    tracks[ch].add_event(0, 0xC0 | ch, 6)
             if not item[idx + 4] is None:  # ボリューム
                 make_track(ch)
                 volumes[ch] = item[idx + 4]
@@ -260,11 +518,16 @@ def make_midi(src, outPath):
                 rest_time[ch] += note_len
             else:
                 note_time[ch] += note_len
+        cur_time += note_len
+    if tempo is None:
+        conductor.add_tempo(0, bpm_to_tempo(120))
+    chunks = [conductor.to_bytes()]
     for ch in range(4):
         put_note(ch, -1)
         if has_note[ch]:
-            mid.tracks.append(tracks[ch])
-    mid.save(outPath)
+            chunks.append(tracks[ch].to_bytes())
+    header = struct.pack(">hhh", 1, len(chunks), MIDI_TICKS_PER_BEAT)
+    return b"MThd" + len(header).to_bytes(4, "big") + header + b"".join(chunks)
 
 
 def shorten(s):
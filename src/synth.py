@@ -0,0 +1,184 @@
+import argparse
+import json
+import os
+import wave
+from multiprocessing import Pool
+import numpy as np
+
+# Pyxelの音声仕様に合わせた定数
+SAMPLE_RATE = 22050
+SPEED_SECONDS = 1 / 120  # speed=1のときの1音の長さ
+VIBRATO_HZ = 6
+VIBRATO_DEPTH = 0.015
+NOISE_STEPS = 8  # ノイズは音の周波数の8倍でLFSRを進める
+# 4チャンネル全部が最大音量でもクリップしないようにする
+CHANNEL_GAIN = 0.25
+MAX_VOLUME = 7
+
+NOTE_NAMES = {"c": 0, "d": 2, "e": 4, "f": 5, "g": 7, "a": 9, "b": 11}
+
+_noise_table = None
+
+
+# "c#2 d-2 r" 形式の文字列をノート番号のリストにする（休符は-1）
+def parse_notes(note_str):
+    notes = []
+    s = note_str.replace(" ", "").lower()
+    idx = 0
+    while idx < len(s):
+        c = s[idx]
+        if c == "r":
+            notes.append(-1)
+            idx += 1
+            continue
+        note = NOTE_NAMES[c]
+        idx += 1
+        if s[idx] == "#":
+            note += 1
+            idx += 1
+        elif s[idx] == "-":
+            note -= 1
+            idx += 1
+        notes.append(note + int(s[idx]) * 12)
+        idx += 1
+    return notes
+
+
+# ノート数に合わせて値を並べる（指定が短ければ繰り返す）
+def expand(values, count):
+    values = values.replace(" ", "")
+    return [values[idx % len(values)] for idx in range(count)]
+
+
+def note_to_freq(notes):
+    return 440.0 * 2.0 ** ((notes - 33) / 12)
+
+
+# 15bitのLFSRで作るノイズ（-1/1）
+def get_noise_table():
+    global _noise_table
+    if _noise_table is None:
+        bits = []
+        reg = 1
+        for _ in range(32767):
+            bits.append(reg & 1)
+            bit = (reg ^ (reg >> 1)) & 1
+            reg = (reg >> 1) | (bit << 14)
+        _noise_table = np.array(bits, dtype=np.float64) * 2 - 1
+    return _noise_table
+
+
+# 1チャンネル分のサウンド（[note, tone, volume, effect, speed]）をPCM（-1〜1）にする
+def render_sound(sound, sample_rate=SAMPLE_RATE):
+    note_str, tone_str, volume_str, effect_str, speed = sound
+    notes = np.array(parse_notes(note_str))
+    count = len(notes)
+    if count == 0:
+        return np.zeros(0)
+    tones = np.array(expand(tone_str.upper(), count))
+    volumes = np.array([int(v) for v in expand(volume_str, count)]) / MAX_VOLUME
+    effects = np.array(expand(effect_str.lower(), count))
+    samples_per_note = sample_rate * SPEED_SECONDS * speed
+    length = int(count * samples_per_note)
+    positions = np.arange(length)
+    idx = (positions / samples_per_note).astype(np.int64)
+    # ノート内の経過割合（スライド・フェードアウト用）
+    starts = (np.arange(count) * samples_per_note).astype(np.int64)
+    ends = np.append(starts[1:], length)
+    progress = (positions - starts[idx]) / (ends - starts)[idx]
+    # 周波数（休符は0、スライドは直前の音から、ビブラートは全体の時間で揺らす）
+    is_rest = notes < 0
+    freqs = np.where(is_rest, 0.0, note_to_freq(np.maximum(notes, 0)))
+    prev_freqs = np.append(freqs[:1], freqs[:-1])
+    prev_freqs = np.where(prev_freqs > 0, prev_freqs, freqs)
+    freq = freqs[idx]
+    slide = effects[idx] == "s"
+    start_freq = prev_freqs[idx][slide]
+    freq[slide] = start_freq + (freq[slide] - start_freq) * progress[slide]
+    vibrato = effects[idx] == "v"
+    freq[vibrato] *= 1 + VIBRATO_DEPTH * np.sin(
+        2 * np.pi * VIBRATO_HZ * positions[vibrato] / sample_rate
+    )
+    phase = np.cumsum(freq / sample_rate)
+    # 波形
+    frac = phase - np.floor(phase)
+    wave_tones = tones[idx]
+    output = np.zeros(length)
+    mask = wave_tones == "T"
+    output[mask] = 1 - 4 * np.abs(frac[mask] - 0.5)
+    mask = wave_tones == "S"
+    output[mask] = np.where(frac[mask] < 0.5, 1.0, -1.0)
+    mask = wave_tones == "P"
+    output[mask] = np.where(frac[mask] < 0.25, 1.0, -1.0)
+    mask = wave_tones == "N"
+    noise = get_noise_table()
+    steps = (phase[mask] * NOISE_STEPS).astype(np.int64) % len(noise)
+    output[mask] = noise[steps]
+    # 音量（フェードアウトはノートの終わりに向けて0にする）
+    level = volumes[idx]
+    fade = effects[idx] == "f"
+    level[fade] *= 1 - progress[fade]
+    level[is_rest[idx]] = 0
+    return output * level
+
+
+# sounds.compileの結果（チャンネルごとのサウンド、音がなければNone）をミックスする
+def render_music(music, sample_rate=SAMPLE_RATE, loops=1):
+    channels = [render_sound(sound, sample_rate) for sound in music if sound]
+    length = max([len(samples) for samples in channels], default=0)
+    mixed = np.zeros(length)
+    for samples in channels:
+        mixed[: len(samples)] += samples * CHANNEL_GAIN
+    return np.tile(mixed, loops)
+
+
+# 16bitモノラルのWAVファイルを書き出す（outPathにはファイルパスかバイナリのファイルオブジェクト）
+def save_wav(music, outPath, sample_rate=SAMPLE_RATE, loops=1):
+    samples = render_music(music, sample_rate, loops)
+    pcm = (np.clip(samples, -1, 1) * 32767).astype("<i2")
+    with wave.open(outPath, "wb") as fout:
+        fout.setnchannels(1)
+        fout.setsampwidth(2)
+        fout.setframerate(sample_rate)
+        fout.writeframes(pcm.tobytes())
+
+
+# music.json（またはsounds.compileの結果のjson）をWAVにする
+def convert_file(path, out_dir, loops=1):
+    with open(path, "rt") as fin:
+        music = json.loads(fin.read())
+    if isinstance(music, dict):
+        music = music["music"]
+    name = os.path.splitext(os.path.basename(path))[0]
+    out_path = os.path.join(out_dir, name + ".wav")
+    save_wav(music, out_path, loops=loops)
+    return out_path
+
+
+def _convert_file(args):
+    return convert_file(*args)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="synth", description="Render music json files to WAV without Pyxel."
+    )
+    parser.add_argument("files", nargs="+", help="music json files")
+    parser.add_argument("--out", default=".", help="output directory")
+    parser.add_argument("--loops", type=int, default=1)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    args = parser.parse_args(argv)
+
+    os.makedirs(args.out, exist_ok=True)
+    jobs = [(path, args.out, args.loops) for path in args.files]
+    if args.workers <= 1:
+        for out_path in map(_convert_file, jobs):
+            print(out_path)
+    else:
+        with Pool(args.workers) as pool:
+            for out_path in pool.imap_unordered(_convert_file, jobs):
+                print(out_path)
+
+
+if __name__ == "__main__":
+    main()
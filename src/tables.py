@@ -0,0 +1,136 @@
+import weakref
+from bisect import bisect_right
+from collections import namedtuple
+
+# コード進行の1区間（generator.jsonのprogressionを読み込んだもの）
+# notes：12音それぞれの種類（0〜9の整数）、root：ベース音（種類2）の位置
+# mask：構成音（種類1〜3）の12bitマスク、no_root：構成音が4つ以上あるか
+Progression = namedtuple(
+    "Progression", ("loc", "repeat", "notes", "root", "mask", "no_root")
+)
+
+
+# サブパートの音域を覚えておく数（超えたら捨てて作り直す）
+SUBNOTES_CACHE_SIZE = 65536
+
+
+# 16分音符が含まれるか
+def has_16th_note(line):
+    prev_str = None
+    for i in line:
+        if i == 0 and prev_str == 0:
+            return True
+        prev_str = i
+    return False
+
+
+def make_progression(progression):
+    repeat = progression["repeat"] if "repeat" in progression else None
+    if not "notes" in progression:
+        return Progression(progression["loc"], repeat, None, None, 0, False)
+    notes = tuple(int(s) for s in progression["notes"])
+    root = None
+    mask = 0
+    for idx in range(12):
+        if notes[idx] == 2:
+            root = idx
+        if notes[idx] in [1, 2, 3]:
+            mask |= 1 << idx
+    no_root = bin(mask).count("1") > 3
+    return Progression(progression["loc"], repeat, notes, root, mask, no_root)
+
+
+# 生成用データ（tables）から作った検索用の表
+# 読み込んだ後は変更しない（音域だけは使ったときに作って覚えておく）
+class TableIndex:
+    def __init__(self, tables):
+        generator = tables["generator"]
+        self.chords = tuple(
+            tuple(make_progression(p) for p in chord["progression"])
+            for chord in generator["chords"]
+        )
+        self.rhythm = tuple(tuple(line) for line in tables["rhythm"])
+        self.rhythm_has16 = tuple(has_16th_note(line) for line in self.rhythm)
+        self.note_ranges = {}
+        self.subnotes = {}
+
+    # コードの音域（最低音以上の構成音を、最初の音から15半音上まで）
+    def get_chord_notes(self, chord, prog_idx, transpose, lowest_note):
+        key = (chord, prog_idx, transpose, lowest_note)
+        if key in self.note_ranges:
+            return self.note_ranges[key]
+        notes = self.chords[chord][prog_idx].notes
+        note_highest = None
+        idx = 0
+        results = []
+        while True:
+            note_type = notes[idx % 12]
+            note = 12 + idx + transpose
+            if note >= lowest_note:
+                if note_type in [1, 2, 3, 9]:
+                    results.append((note, note_type))
+                    if note_highest is None:
+                        note_highest = note + 15
+            if note_highest and note >= note_highest:
+                break
+            idx += 1
+        self.note_ranges[key] = tuple(results)
+        return self.note_ranges[key]
+
+    # サブパートの音域（ベース+3〜メイン-3の音）と、そのうちの構成音（種類1〜3）の一覧
+    def get_subnotes(self, notes, master_note, base_note, transpose):
+        key = (notes, master_note, base_note, transpose)
+        entry = self.subnotes.get(key)
+        if entry is not None:
+            return entry
+        results = []
+        has_important_tone = False
+        idx = 0
+        while notes:
+            note_type = notes[idx % 12]
+            if note_type in [1, 2, 3, 9]:
+                note = 12 + idx + transpose
+                if note > master_note - 3 and has_important_tone:
+                    break
+                if note >= base_note + 3:
+                    results.append((note, note_type))
+                    if note_type in [1, 3]:
+                        has_important_tone = True
+            idx += 1
+        chord_tones = tuple(n[0] for n in results if n[1] in [1, 2, 3])
+        entry = (tuple(results), chord_tones)
+        if len(self.subnotes) >= SUBNOTES_CACHE_SIZE:
+            self.subnotes.clear()
+        self.subnotes[key] = entry
+        return entry
+
+
+# 構成音の一覧（昇順）から、highest以下lowest以上で一番高い音を探す（なければNone）
+def find_lower_tone(chord_tones, highest, lowest):
+    idx = bisect_right(chord_tones, highest)
+    if idx and chord_tones[idx - 1] >= lowest:
+        return chord_tones[idx - 1]
+    return None
+
+
+# 生成用データ（load_tablesで読み込んだもの。弱参照できるようにdictを継承する）
+class Tables(dict):
+    pass
+
+
+# 同じtablesには同じ表を使う（tablesがなくなったら表も捨てる）
+_indexes = {}
+
+
+def get_index(tables):
+    key = id(tables)
+    entry = _indexes.get(key)
+    if entry is not None and entry[0]() is tables:
+        return entry[1]
+    index = TableIndex(tables)
+    try:
+        ref = weakref.ref(tables, lambda _: _indexes.pop(key, None))
+    except TypeError:  # 普通のdictは覚えておけないので、そのたびに作る
+        return index
+    _indexes[key] = (ref, index)
+    return index
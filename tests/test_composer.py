@@ -0,0 +1,147 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from cache import SongCache
+from composer import Composer, load_tables
+from profiler import Profiler
+
+TABLES = load_tables()
+# 部分的に作り直せるパラメータと、変えたときの値
+UPDATES = (
+    ("speed", lambda parm: 360 if parm["speed"] != 360 else 240),
+    ("melo_tone", lambda parm: (parm["melo_tone"] + 1) % 6),
+    ("sub_tone", lambda parm: (parm["sub_tone"] + 1) % 6),
+    ("base_quantize", lambda parm: 12 + (parm["base_quantize"] - 11) % 4),
+    ("drums", lambda parm: (parm["drums"] + 1) % len(TABLES["generator"]["drums"])),
+    ("base", lambda parm: (parm["base"] + 1) % len(TABLES["generator"]["base"])),
+)
+
+
+def make_composer(preset, instrumentation, cache=None, profiler=None):
+    composer = Composer(
+        {"transpose": 0, "base_highest_note": 26}, TABLES, profiler, cache
+    )
+    composer.set_preset(preset)
+    composer.parm["instrumentation"] = instrumentation
+    return composer
+
+
+def generate_fresh(parm, seed):
+    composer = Composer(dict(parm), TABLES)
+    composer.generate_music(seed=seed)
+    return composer.items, composer.music
+
+
+def next_base(parm):
+    return (parm["base"] + 1) % len(TABLES["generator"]["base"])
+
+
+class UpdateMusicTest(unittest.TestCase):
+    # メロディを作り直さない変更は、同じシードで最初から作ったものと同じになる
+    def test_update_matches_fresh_generate(self):
+        partial = 0
+        for preset in range(len(TABLES["generator"]["preset"])):
+            for instrumentation in range(4):
+                for key, change in UPDATES:
+                    profiler = Profiler()
+                    composer = make_composer(preset, instrumentation, None, profiler)
+                    composer.generate_music(seed=preset * 4 + instrumentation)
+                    retried = composer.failure_cnt > 0
+                    profiler.reset()
+                    composer.parm[key] = change(composer.parm)
+                    items, music = composer.update_music()
+                    expected = generate_fresh(composer.parm, composer.seed)
+                    self.assertEqual((items, music), expected, (preset, key))
+                    # メロディを作り直した曲のベース以外は、メロディを生成しない
+                    if key != "base" or not retried:
+                        self.assertNotIn("melody", profiler.stages, (preset, key))
+                        partial += 1
+        self.assertGreater(partial, 0)
+
+    # 続けて変更しても、最初から作ったものと同じになる
+    def test_update_sequence_matches_fresh_generate(self):
+        for instrumentation in range(4):
+            composer = make_composer(2, instrumentation)
+            composer.generate_music(seed=11)
+            for key, change in UPDATES * 2:
+                composer.parm[key] = change(composer.parm)
+                result = composer.update_music()
+                self.assertEqual(result, generate_fresh(composer.parm, 11), key)
+
+
+class CacheHitThenUpdateTest(unittest.TestCase):
+    # キャッシュから戻した曲のベースを変えると、同じシードで作り直したものと同じになる
+    def test_base_update_after_cache_hit_matches_fresh_generate(self):
+        chords = len(TABLES["generator"]["chords"])
+        for preset in range(len(TABLES["generator"]["preset"])):
+            for instrumentation in range(4):
+                composer = make_composer(preset, instrumentation, SongCache(TABLES))
+                chord = composer.parm["chord"]
+                composer.generate_music(seed=5)
+                composer.parm["chord"] = (chord + 1) % chords
+                composer.generate_music(seed=5)
+                composer.parm["chord"] = chord
+                composer.generate_music(seed=5)
+                self.assertTrue(composer.from_cache)
+                composer.parm["base"] = next_base(composer.parm)
+                items, _ = composer.update_music()
+                self.assertEqual(items, generate_fresh(composer.parm, 5)[0])
+
+    # 最初の生成がキャッシュから出た場合も、そのまま変更できる
+    def test_update_after_first_generate_is_cache_hit(self):
+        for instrumentation in range(4):
+            cache = SongCache(TABLES)
+            make_composer(1, instrumentation, cache).generate_music(seed=3)
+            composer = make_composer(1, instrumentation, cache)
+            composer.generate_music(seed=3)
+            self.assertTrue(composer.from_cache)
+            composer.parm["base"] = next_base(composer.parm)
+            items, _ = composer.update_music()
+            self.assertEqual(items, generate_fresh(composer.parm, 3)[0])
+
+
+class RhythmSetTest(unittest.TestCase):
+    # 16分音符が出るまで選び直したリズムも、位置が昇順に並ぶ
+    def test_use16_rhythm_is_ordered(self):
+        composer = make_composer(1, 0)
+        composer.parm["melo_use16"] = True
+        composer.set_seed(453)
+        composer.set_chord_lists()
+        for _ in range(50):
+            locs = composer.get_rhythm_set().locs
+            self.assertEqual(locs, sorted(locs))
+
+    # 前の区間に戻って上書きしないので、まだ置いていない音（-2）が残らない
+    def test_use16_melody_has_no_placeholder(self):
+        composer = make_composer(1, 0)
+        composer.parm["melo_use16"] = True
+        items, _ = composer.generate_music(seed=453)
+        self.assertNotIn(-2, [item[6] for item in items])
+
+
+class MelodySegmentTest(unittest.TestCase):
+    # やり直さずに採用したメロディは、全区間に重要構成音が揃っている
+    def test_accepted_melody_has_all_need_notes(self):
+        for preset in range(len(TABLES["generator"]["preset"])):
+            composer = make_composer(preset, 0)
+            composer.parm["melo_use16"] = True
+            for seed in range(20):
+                composer.generate_music(seed=seed)
+                if composer.failure_cnt == 0:
+                    self.assertIsNone(composer.get_missing_segment())
+
+    # 後から前の区間を書き換えたら、足りない区間として見つかる
+    def test_overwritten_segment_is_found(self):
+        composer = make_composer(0, 0)
+        composer.generate_music(seed=1)
+        start = composer.chord_lists[0]["loc"]
+        for loc in range(start, composer.chord_lists[1]["loc"]):
+            composer.melody_notes[loc] = -1
+        self.assertEqual(composer.get_missing_segment(), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,54 @@
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from composer import Composer, load_tables
+from exporter import ExportJob
+
+TABLES = load_tables()
+NAMES = {"json": "music.json", "wav": "music.wav", "midi": "music.mid"}
+
+
+def make_job(output_path, render_wav=None):
+    composer = Composer({"transpose": 0, "base_highest_note": 26}, TABLES)
+    composer.set_preset(0)
+    composer.generate_music(seed=1)
+    return ExportJob(output_path, NAMES, composer.export(), composer.items, render_wav)
+
+
+class ExportJobTest(unittest.TestCase):
+    def test_done(self):
+        with tempfile.TemporaryDirectory() as output_path:
+            job = make_job(output_path)
+            job.run()
+            self.assertFalse(job.running)
+            self.assertFalse(job.failed)
+            self.assertEqual(job.done, job.total)
+            self.assertTrue(os.path.exists(os.path.join(output_path, "music.json")))
+
+    # WAVは渡した関数で書き出す
+    def test_render_wav(self):
+        paths = []
+        with tempfile.TemporaryDirectory() as output_path:
+            job = make_job(output_path, paths.append)
+            job.run()
+            self.assertEqual(job.done, 3)
+            self.assertEqual(paths, [os.path.join(output_path, "music.wav")])
+
+    # 書き出せなかったら完了ではなく失敗になる
+    def test_failed(self):
+        with tempfile.TemporaryDirectory() as output_path:
+            job = make_job(os.path.join(output_path, "missing"))
+            job.run()
+            self.assertFalse(job.running)
+            self.assertTrue(job.failed)
+            self.assertEqual(job.failed_name, "music.json")
+            self.assertIsInstance(job.error, OSError)
+            self.assertEqual(job.done, 0)
+
+
+if __name__ == "__main__":
+    unittest.main()